@@ -0,0 +1,209 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import socket
+import sys
+
+# flags of recvmmsg(2), from <sys/socket.h>
+MSG_WAITFORONE = 0x10000
+
+
+class _IOVec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p),
+                ('iov_len', ctypes.c_size_t)]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p),
+                ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(_IOVec)),
+                ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p),
+                ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', _MsgHdr),
+                ('msg_len', ctypes.c_uint)]
+
+
+class _SockAddrIn(ctypes.Structure):
+    _fields_ = [('sin_family', ctypes.c_ushort),
+                ('sin_port', ctypes.c_uint16),
+                ('sin_addr', ctypes.c_uint8 * 4),
+                ('sin_zero', ctypes.c_uint8 * 8)]
+
+
+def _load_libc():
+    """Returns libc if it provides sendmmsg and recvmmsg, None otherwise"""
+    if not sys.platform.startswith('linux'):
+        return None
+    
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno = True)
+        libc.sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+        libc.recvmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    except (OSError, AttributeError):
+        return None
+    
+    return libc
+
+
+_libc = _load_libc()
+HAVE_MMSG = _libc is not None
+
+
+class _MessageVector(object):
+    """
+    Preallocated mmsghdr array, each message pointing at its own slot of one contiguous buffer
+    
+    The buffer, the iovec lengths and the message lengths are all exposed as memoryviews so that filling and
+    draining a batch costs a slice assignment per datagram rather than several ctypes attribute lookups
+    """
+    
+    def __init__(self, batch_size, datagram_size):
+        """
+        :param batch_size: number of messages in the vector
+        :param datagram_size: size of each buffer slot
+        """
+        self.batch_size = batch_size
+        self.datagram_size = datagram_size
+        self.buffer = bytearray(batch_size * datagram_size)
+        self.view = memoryview(self.buffer)
+        self.base = ctypes.addressof(ctypes.c_char.from_buffer(self.buffer))
+        
+        self.iovec_storage = bytearray(batch_size * ctypes.sizeof(_IOVec))
+        self.iovecs = (_IOVec * batch_size).from_buffer(self.iovec_storage)
+        # iov_len of message i is at index 2 * i + 1
+        self.iov_lens = memoryview(self.iovec_storage).cast('N')
+        
+        self.message_storage = bytearray(batch_size * ctypes.sizeof(_MMsgHdr))
+        self.messages = (_MMsgHdr * batch_size).from_buffer(self.message_storage)
+        self.messages_base = ctypes.addressof(self.messages)
+        # msg_len of message i is at index i * msg_len_stride + msg_len_start
+        self.msg_lens = memoryview(self.message_storage).cast('I')
+        self.msg_len_stride = ctypes.sizeof(_MMsgHdr) // 4
+        self.msg_len_start = _MMsgHdr.msg_len.offset // 4
+        
+        for i in range(batch_size):
+            self.iovecs[i].iov_base = self.base + i * datagram_size
+            self.iovecs[i].iov_len = datagram_size
+            self.messages[i].msg_hdr.msg_iov = ctypes.pointer(self.iovecs[i])
+            self.messages[i].msg_hdr.msg_iovlen = 1
+
+
+def _raise_errno():
+    """Raises the error left in errno by the last libc call"""
+    err = ctypes.get_errno()
+    raise OSError(err, os.strerror(err))
+
+
+class BatchSender(object):
+    """Sends lists of datagrams to one address with as few sendmmsg calls as possible"""
+    
+    def __init__(self, sock, address, batch_size, datagram_size):
+        """
+        :param sock: UDP socket to send from
+        :param address: (IP address, port) the datagrams are sent to
+        :param batch_size: maximum number of datagrams handed to the kernel in one call, 1 disables batching
+        :param datagram_size: size of the largest datagram that will be sent
+        """
+        self.sock = sock
+        self.address = address
+        self.batched = HAVE_MMSG and batch_size > 1
+        
+        if self.batched:
+            self.vector = _MessageVector(batch_size, datagram_size)
+            self.sockaddr = _SockAddrIn(socket.AF_INET, socket.htons(address[1]),
+                                        (ctypes.c_uint8 * 4)(*socket.inet_aton(socket.gethostbyname(address[0]))))
+            
+            for i in range(batch_size):
+                self.vector.messages[i].msg_hdr.msg_name = ctypes.addressof(self.sockaddr)
+                self.vector.messages[i].msg_hdr.msg_namelen = ctypes.sizeof(self.sockaddr)
+    
+    def send(self, datagrams):
+        """
+        Sends all the datagrams in order
+        
+        :param datagrams: list of byte strings, at most batch_size of them when batching
+        """
+        if not self.batched:
+            for data in datagrams:
+                self.sock.sendto(data, self.address)
+            return
+        
+        vector = self.vector
+        view, iov_lens, size = vector.view, vector.iov_lens, vector.datagram_size
+        
+        for i, data in enumerate(datagrams):
+            view[i * size:i * size + len(data)] = data
+            iov_lens[2 * i + 1] = len(data)
+        
+        sent = 0
+        while sent < len(datagrams):
+            count = _libc.sendmmsg(self.sock.fileno(), vector.messages_base + sent * ctypes.sizeof(_MMsgHdr),
+                                   len(datagrams) - sent, 0)
+            
+            if count < 0:
+                err = ctypes.get_errno()
+                if err == errno.EAGAIN:
+                    # socket buffer is full, wait for it to drain
+                    select.select([], [self.sock], [])
+                elif err != errno.EINTR:
+                    _raise_errno()
+                continue
+            
+            sent += count
+
+
+class BatchReceiver(object):
+    """Receives as many queued datagrams as possible with one recvmmsg call"""
+    
+    def __init__(self, sock, batch_size, datagram_size):
+        """
+        :param sock: UDP socket to receive from
+        :param batch_size: maximum number of datagrams taken from the kernel in one call, 1 disables batching
+        :param datagram_size: size of the largest datagram that can be received
+        """
+        self.sock = sock
+        self.datagram_size = datagram_size
+        self.batched = HAVE_MMSG and batch_size > 1
+        
+        if self.batched:
+            self.vector = _MessageVector(batch_size, datagram_size)
+    
+    def recv(self):
+        """
+        Waits up to the socket timeout for datagrams to arrive, returning right away on a non-blocking socket
+        
+        :return: list of the received datagrams, empty if none arrived in time
+        """
+        if not self.batched:
+            try:
+                return [self.sock.recvfrom(self.datagram_size)[0]]
+            except (socket.timeout, BlockingIOError):
+                return []
+        
+        timeout = self.sock.gettimeout()
+        if timeout and not select.select([self.sock], [], [], timeout)[0]:
+            return []
+        
+        vector = self.vector
+        while True:
+            count = _libc.recvmmsg(self.sock.fileno(), vector.messages_base, vector.batch_size, MSG_WAITFORONE, None)
+            
+            if count >= 0:
+                break
+            if ctypes.get_errno() == errno.EINTR:
+                continue
+            if ctypes.get_errno() == errno.EAGAIN:
+                return []
+            _raise_errno()
+        
+        view, msg_lens, size = vector.view, vector.msg_lens, vector.datagram_size
+        stride, start = vector.msg_len_stride, vector.msg_len_start
+        
+        return [view[i * size:i * size + msg_lens[i * stride + start]].tobytes() for i in range(count)]
@@ -0,0 +1,476 @@
+import base64
+import filecmp
+import importlib.util
+import itertools
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import click
+
+# directory of this script, the transfer engines are started from it
+ROOT = os.path.dirname(os.path.abspath(__file__))
+BASELINES = os.path.join(ROOT, 'TypeOfReliableUDP')
+
+# the RBUDP pair numbers its blocks of 1 KB in 16 bits and always listens on this TCP port
+RBUDP_MAX_SIZE = 65536 * 1024
+RBUDP_TCP_PORT = 12001
+
+# seconds a server is given to start listening, and to exit once asked to
+START_TIMEOUT = 10
+STOP_TIMEOUT = 5
+
+
+def parse_list(convert):
+    """
+    :param convert: function converting each item
+    :return: click callback splitting a comma separated option into a list of items
+    """
+    def callback(ctx, param, value):
+        try:
+            return [convert(item) for item in value.split(',') if item.strip()]
+        except ValueError:
+            raise click.BadParameter('expected a comma separated list, got {}'.format(value))
+    
+    return callback
+
+
+def generate_file(path, size, seed):
+    """
+    Writes a file of printable text, the RUDP pair reading and writing files in text mode
+    
+    :param path: path of the file
+    :param size: size of the file in bytes
+    :param seed: seed of the random data, so that every run of the benchmark transfers the same files
+    """
+    rng = random.Random(seed)
+    # base64 turns 3 random bytes into 4 characters
+    chunk = 3 * 1024 * 256
+    
+    with open(path, 'wb') as f:
+        written = 0
+        
+        while written < size:
+            data = base64.b64encode(rng.getrandbits(8 * chunk).to_bytes(chunk, 'little'))[:size - written]
+            f.write(data)
+            written += len(data)
+
+
+def free_port(kind = socket.SOCK_STREAM):
+    """
+    :param kind: socket type the port is for
+    :return: a port of the loopback interface no socket is bound to
+    """
+    with socket.socket(socket.AF_INET, kind) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def udp_counters():
+    """
+    :return: UDP counters of the host by name, from /proc/net/snmp, empty where it does not exist
+    """
+    try:
+        with open('/proc/net/snmp', 'r') as f:
+            lines = [line.split() for line in f if line.startswith('Udp:')]
+    except OSError:
+        return {}
+    
+    return dict(zip(lines[0][1:], (int(value) for value in lines[1][1:])))
+
+
+class Process(object):
+    """A transfer engine run by the benchmark, logging to a file and accounted for once it exits"""
+    
+    def __init__(self, args, cwd, log_path):
+        """
+        :param args: arguments of the Python script to run, starting with its path
+        :param cwd: directory the script runs in
+        :param log_path: file its output is written to
+        """
+        self.log_path = log_path
+        self.log = open(log_path, 'w')
+        self.popen = subprocess.Popen([sys.executable, '-u'] + args, cwd = cwd, stdout = self.log,
+                                      stderr = subprocess.STDOUT, stdin = subprocess.DEVNULL)
+        self.returncode = None
+        self.cpu_time = None
+        self.peak_rss = None
+    
+    def output(self):
+        with open(self.log_path, 'r', errors = 'replace') as f:
+            return f.read()
+    
+    def wait(self, timeout):
+        """
+        Waits for the process to exit, reaping it with wait4 so that its own resource usage is known
+        
+        :param timeout: seconds to wait at most
+        :return: True if the process exited
+        """
+        deadline = time.time() + timeout
+        
+        while self.returncode is None:
+            pid, status, usage = os.wait4(self.popen.pid, os.WNOHANG)
+            
+            if pid:
+                self.reap(status, usage)
+                break
+            
+            if time.time() >= deadline:
+                return False
+            
+            time.sleep(.01)
+        
+        return True
+    
+    def reap(self, status, usage):
+        self.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+        # keep subprocess from waiting for the process again
+        self.popen.returncode = self.returncode
+        self.cpu_time = usage.ru_utime + usage.ru_stime
+        # in KB on Linux, in bytes on macOS
+        self.peak_rss = usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+        self.log.close()
+    
+    def stop(self):
+        """Asks the process to exit, killing it if it does not"""
+        if self.returncode is not None:
+            return
+        
+        self.popen.send_signal(signal.SIGTERM)
+        
+        if not self.wait(STOP_TIMEOUT):
+            self.popen.kill()
+            self.reap(*os.wait4(self.popen.pid, 0)[1:])
+
+
+class Engine(object):
+    """
+    How to serve and download a file with one of the transfer engines
+    
+    Subclasses build the command lines of the server and the client for a set of parameters, and read the number of
+    retransmission rounds from their output
+    """
+    
+    name = None
+    # text printed by the server once it listens, None to give it a moment instead
+    ready = None
+    
+    def available(self):
+        """
+        :return: None if the engine can run here, otherwise why not
+        """
+        return None
+    
+    def runs(self, options):
+        """
+        :param options: dictionary of the options of the benchmark
+        :return: dictionaries of the parameters of each run of a file, as swept by the options
+        """
+        return [{}]
+    
+    def skip(self, size, params):
+        """
+        :param size: size of the file
+        :param params: parameters of the run
+        :return: None if the file can be transferred with the parameters, otherwise why not
+        """
+        return None
+    
+    def server_args(self, params, port):
+        raise NotImplementedError
+    
+    def client_args(self, params, port, filename):
+        raise NotImplementedError
+    
+    def output_name(self, filename):
+        """
+        :param filename: name of the file downloaded
+        :return: name of the copy written by the client
+        """
+        raise NotImplementedError
+    
+    def rounds(self, server_output, client_output):
+        """
+        :return: number of retransmission rounds of the transfer, None if the engine does not tell
+        """
+        return None
+
+
+class MTDEngine(Engine):
+    name = 'mtd'
+    ready = 'Listening for connections'
+    
+    def runs(self, options):
+        return [{'threads': threads, 'rate': rate, 'block_size': block_size}
+                for threads, rate, block_size in itertools.product(options['threads'], options['rates'],
+                                                                   options['block_sizes'])]
+    
+    def server_args(self, params, port):
+        # no digest is kept across runs, every run hashes the file like a first request does
+        return [os.path.join(ROOT, 'MTD_server.py'), '-s', '127.0.0.1', '--server-tcp-port', str(port),
+                '-r', str(params['rate']), '--digest-cache', '']
+    
+    def client_args(self, params, port, filename):
+        return [os.path.join(ROOT, 'MTD_client.py'), '-c', '127.0.0.1', '-s', '127.0.0.1',
+                '--server-tcp-port', str(port), '-f', filename, '-t', str(params['threads']),
+                '--block-size', str(params['block_size'])]
+    
+    def output_name(self, filename):
+        return 'download_' + filename
+    
+    def rounds(self, server_output, client_output):
+        return sum(int(rounds) for rounds in re.findall(r'Retransmission rounds: (\d+)', client_output))
+
+
+class RBUDPEngine(Engine):
+    name = 'rbudp'
+    ready = 'Listening for connections'
+    
+    def runs(self, options):
+        return [{'rate': rate} for rate in options['rates']]
+    
+    def skip(self, size, params):
+        if size > RBUDP_MAX_SIZE:
+            return 'RBUDP numbers at most 65536 blocks of 1 KB'
+        
+        return None
+    
+    def server_args(self, params, port):
+        return [os.path.join(BASELINES, 'RBUDP_server.py'), '127.0.0.1', str(params['rate'])]
+    
+    def client_args(self, params, port, filename):
+        return [os.path.join(BASELINES, 'RBUDP_client.py'), '127.0.0.1', str(free_port(socket.SOCK_DGRAM)),
+                '127.0.0.1', filename]
+    
+    def output_name(self, filename):
+        name, ext = os.path.splitext(filename)
+        return name + '_copy' + ext
+    
+    def rounds(self, server_output, client_output):
+        # the first DONE ends the first round
+        return max(client_output.count('Client: Transmission done') - 1, 0)
+
+
+class RUDPEngine(Engine):
+    name = 'rudp'
+    ready = 'Starting up on'
+    
+    def server_args(self, params, port):
+        return [os.path.join(BASELINES, 'RUDP_server.py'), '127.0.0.1', str(port)]
+    
+    def client_args(self, params, port, filename):
+        return [os.path.join(BASELINES, 'RUDP_client.py'), '127.0.0.1', str(port), filename]
+    
+    def output_name(self, filename):
+        return 'r_' + filename
+    
+    def rounds(self, server_output, client_output):
+        # stop and wait, every packet sent again is a round of its own
+        return server_output.count('Time out reached, resending')
+
+
+class TFTPEngine(Engine):
+    name = 'tftp'
+    
+    def available(self):
+        if importlib.util.find_spec('tftpy') is None:
+            return 'tftpy is not installed'
+        
+        return None
+    
+    def runs(self, options):
+        # TFTP blocks are 65464 bytes at most
+        return [{'block_size': block_size} for block_size in options['block_sizes'] if 0 < block_size <= 65464]
+    
+    def server_args(self, params, port):
+        return [os.path.join(BASELINES, 'TFTP_server.py'), '-i', '127.0.0.1', '-p', str(port), '-r', '.']
+    
+    def client_args(self, params, port, filename):
+        return [os.path.join(BASELINES, 'TFTP_client.py'), '-H', '127.0.0.1', '-p', str(port), '-D', filename,
+                '-o', self.output_name(filename), '-b', str(params['block_size'])]
+    
+    def output_name(self, filename):
+        return 'tftp_' + filename
+
+
+ENGINES = {engine.name: engine for engine in (MTDEngine(), RBUDPEngine(), RUDPEngine(), TFTPEngine())}
+
+
+def start_server(engine, params, work_dir, log_path):
+    """
+    :return: (server Process, port it listens on), the Process having exited if it could not start
+    """
+    # the RBUDP server listens on a fixed port, which may take a moment to be free again after the previous run
+    for attempt in range(3):
+        port = RBUDP_TCP_PORT if engine.name == 'rbudp' else free_port(socket.SOCK_DGRAM if engine.name in (
+            'rudp', 'tftp') else socket.SOCK_STREAM)
+        server = Process(engine.server_args(params, port), work_dir, log_path)
+        deadline = time.time() + (START_TIMEOUT if engine.ready else 1)
+        
+        while time.time() < deadline:
+            if server.wait(0) or (engine.ready and engine.ready in server.output()):
+                break
+            
+            time.sleep(.05)
+        
+        if server.returncode is None:
+            return server, port
+        
+        time.sleep(1)
+    
+    return server, port
+
+
+def run_transfer(engine, params, filename, size, run, work_dir, timeout):
+    """
+    Serves and downloads a file once on loopback
+    
+    :param engine: Engine transferring the file
+    :param params: parameters of the run
+    :param filename: name of the file, in the working directory
+    :param size: size of the file
+    :param run: number of the run of these parameters and file
+    :param work_dir: directory both ends run in
+    :param timeout: seconds the download may take at most
+    :return: dictionary of the results of the run
+    """
+    result = {'engine': engine.name, 'size': size, 'run': run}
+    result.update(params)
+    output_path = os.path.join(work_dir, engine.output_name(filename))
+    
+    # nothing to resume from a previous run
+    for path in (output_path, output_path + '.journal'):
+        if os.path.exists(path):
+            os.remove(path)
+    
+    label = '_'.join(str(value) for value in [engine.name, size] + list(params.values()) + [run])
+    server, port = start_server(engine, params, work_dir, os.path.join(work_dir, label + '_server.log'))
+    
+    if server.returncode is not None:
+        result['error'] = 'server exited with code {}'.format(server.returncode)
+        return result
+    
+    counters = udp_counters()
+    start_time = time.time()
+    client = Process(engine.client_args(params, port, filename), work_dir,
+                     os.path.join(work_dir, label + '_client.log'))
+    
+    if not client.wait(timeout):
+        client.stop()
+        result['error'] = 'timed out after {}s'.format(timeout)
+    
+    seconds = time.time() - start_time
+    after = udp_counters()
+    server.stop()
+    
+    result['seconds'] = round(seconds, 4)
+    result['ok'] = client.returncode == 0 and os.path.exists(output_path) and \
+        filecmp.cmp(os.path.join(work_dir, filename), output_path, shallow = False)
+    result['mb_per_s'] = round(size / seconds / 1e6, 3) if result['ok'] else None
+    
+    # datagrams of every socket of the host, the run is all there is on loopback
+    if counters:
+        result['packets'] = after['OutDatagrams'] - counters['OutDatagrams']
+        result['packets_per_s'] = round(result['packets'] / seconds, 1)
+        result['receive_buffer_errors'] = after.get('RcvbufErrors', 0) - counters.get('RcvbufErrors', 0)
+    
+    result['retransmission_rounds'] = engine.rounds(server.output(), client.output())
+    result['client_cpu_s'] = round(client.cpu_time, 3)
+    result['server_cpu_s'] = round(server.cpu_time, 3)
+    result['client_peak_rss'] = client.peak_rss
+    result['server_peak_rss'] = server.peak_rss
+    
+    if not result['ok'] and 'error' not in result:
+        result['error'] = 'client exited with code {}, the copy differs or is missing'.format(client.returncode)
+    
+    return result
+
+
+@click.command()
+@click.option('-e', '--engines', help = 'Transfer Engines to Run, Comma Separated', default = 'mtd,rbudp,rudp,tftp',
+              callback = parse_list(str))
+@click.option('--sizes', help = 'Sizes of the Files Transferred in MB, Comma Separated', default = '1,16',
+              callback = parse_list(float))
+@click.option('-t', '--threads', help = 'Numbers of Threads of the MTD Client, Comma Separated', default = '1,4',
+              callback = parse_list(int))
+@click.option('-r', '--rates', help = 'Transmission Rates in Mbps of the MTD and RBUDP Servers, Comma Separated',
+              default = '10000', callback = parse_list(float))
+@click.option('--block-sizes', help = 'Bytes of Data per Datagram of MTD and TFTP, Comma Separated, 0 to Fit the MTU',
+              default = '1024,8192', callback = parse_list(int))
+@click.option('--repeat', help = 'Runs of Each Combination', default = 1)
+@click.option('--seed', help = 'Seed of the Generated Files', default = 0)
+@click.option('--timeout', help = 'Seconds a Download May Take at Most', default = 300)
+@click.option('--work-dir', help = 'Directory the Files Are Generated and Downloaded In, Empty for a Temporary One',
+              default = '')
+@click.option('-o', '--output', help = 'JSON File the Results Are Written To', default = 'benchmark.json')
+def start_benchmark(engines, sizes, threads, rates, block_sizes, repeat, seed, timeout, work_dir, output):
+    unknown = [name for name in engines if name not in ENGINES]
+    
+    if unknown:
+        raise click.BadParameter('unknown engines {}'.format(', '.join(unknown)), param_hint = '--engines')
+    
+    options = {'engines': engines, 'sizes': sizes, 'threads': threads, 'rates': rates, 'block_sizes': block_sizes,
+               'repeat': repeat, 'seed': seed, 'timeout': timeout}
+    temporary = not work_dir
+    work_dir = tempfile.mkdtemp(prefix = 'mtd_benchmark_') if temporary else os.path.abspath(work_dir)
+    os.makedirs(work_dir, exist_ok = True)
+    results = []
+    skipped = []
+    
+    try:
+        files = []
+        
+        for i, size in enumerate(sizes):
+            filename = 'bench_{:g}MB.txt'.format(size)
+            size = int(size * 1000 * 1000)
+            generate_file(os.path.join(work_dir, filename), size, seed + i)
+            files.append((filename, size))
+        
+        for name in engines:
+            engine = ENGINES[name]
+            reason = engine.available()
+            
+            if reason is not None:
+                print('Benchmark: Skipping {}, {}'.format(name, reason))
+                skipped.append({'engine': name, 'reason': reason})
+                continue
+            
+            for (filename, size), params in itertools.product(files, engine.runs(options)):
+                reason = engine.skip(size, params)
+                
+                if reason is not None:
+                    skipped.append(dict(engine = name, size = size, reason = reason, **params))
+                    continue
+                
+                for run in range(repeat):
+                    result = run_transfer(engine, params, filename, size, run + 1, work_dir, timeout)
+                    results.append(result)
+                    print('Benchmark: {} {} bytes {}: {}'.format(name, size, params, 'failed, ' + result['error']
+                                                                 if 'error' in result else
+                                                                 '{} MB/s'.format(result['mb_per_s'])))
+    finally:
+        if temporary:
+            shutil.rmtree(work_dir, ignore_errors = True)
+        
+        report = {'host': {'platform': platform.platform(), 'python': platform.python_version(),
+                           'cpus': os.cpu_count()},
+                  'options': options, 'results': results, 'skipped': skipped}
+        
+        with open(output, 'w') as f:
+            json.dump(report, f, indent = 2)
+        
+        print('Benchmark: Results written to {}'.format(output))
+
+
+if __name__ == '__main__':
+    start_benchmark()
@@ -0,0 +1,113 @@
+import os
+import threading
+from collections import OrderedDict
+
+from MTD_digest import file_identity
+from MTD_protocol import PIECE_SIZE
+
+
+class BlockCache(object):
+    """
+    Pieces of served files kept in memory up to a budget with LRU eviction, shared by every session and stream
+    
+    Pieces rather than blocks are cached, so that sessions negotiating different block sizes share them. Entries are
+    keyed by the file identity, so the pieces of a file that is modified, truncated or replaced are dropped as soon as
+    a stream opens the new version, and never served for it
+    """
+    
+    def __init__(self, budget):
+        """
+        :param budget: maximum number of bytes of file data kept, 0 to read every block from disk
+        """
+        self.budget = budget
+        self.size = 0
+        self.pieces = OrderedDict()
+        # events set once the piece being read from disk by a stream is cached, so other streams wait for it rather
+        # than read it too
+        self.loading = {}
+        # current identity of each file seen
+        self.files = {}
+        # shared by the streams of the threaded engine
+        self.lock = threading.Lock()
+    
+    def identify(self, filename):
+        """
+        Drops the cached pieces of any previous version of a file
+        
+        :param filename: path of a file about to be served
+        :return: identity of the file, to read it with
+        """
+        identity = file_identity(filename)
+        path = identity[0]
+        
+        with self.lock:
+            if self.files.get(path, identity) != identity:
+                for key in [key for key in self.pieces if key[0][0] == path]:
+                    self.size -= len(self.pieces.pop(key))
+            
+            self.files[path] = identity
+        
+        return identity
+    
+    def read(self, identity, f, offset, length):
+        """
+        :param identity: identity of the file, as given by identify
+        :param f: the file, open
+        :param offset: offset of the data in the file
+        :param length: number of bytes to read
+        :return: the data, as bytes or a memoryview
+        """
+        if not self.budget:
+            return os.pread(f.fileno(), length, offset)
+        
+        first, last = offset // PIECE_SIZE, (offset + length - 1) // PIECE_SIZE
+        start = offset - first * PIECE_SIZE
+        
+        if first == last:
+            return memoryview(self.piece(identity, f, first))[start:start + length]
+        
+        # only segments not starting on a piece boundary, for clients of the original protocol, straddle pieces
+        data = b''.join(self.piece(identity, f, index) for index in range(first, last + 1))
+        return data[start:start + length]
+    
+    def piece(self, identity, f, index):
+        """
+        :param identity: identity of the file
+        :param f: the file, open
+        :param index: index of the piece in the file
+        :return: the piece, read from disk only if it is not cached
+        """
+        key = (identity, index)
+        
+        while True:
+            with self.lock:
+                data = self.pieces.get(key)
+                
+                if data is not None:
+                    self.pieces.move_to_end(key)
+                    return data
+                
+                loading = self.loading.get(key)
+                
+                if loading is None:
+                    loading = self.loading[key] = threading.Event()
+                    break
+            
+            loading.wait()
+        
+        try:
+            data = os.pread(f.fileno(), PIECE_SIZE, index * PIECE_SIZE)
+            
+            with self.lock:
+                self.pieces[key] = data
+                self.size += len(data)
+                
+                while self.size > self.budget:
+                    self.size -= len(self.pieces.popitem(last = False)[1])
+        finally:
+            with self.lock:
+                del self.loading[key]
+            
+            loading.set()
+        
+        return data
@@ -1,28 +1,77 @@
 import hashlib
+import io
 import os
 import pickle
+import re
+import selectors
 import socket
+import struct
+import sys
 import threading
 import time
+from collections import deque
 from glob import glob
 from shutil import copyfileobj
 
 import click
 from tqdm import tqdm
 
+from MTD_batchio import BatchReceiver
+from MTD_compress import decompress_blocks, supported_codecs
+from MTD_digest import merkle_root
+from MTD_protocol import (ATTACH, ATTACH_BODY, BLOCK_SIZE, CODEC_MASK, DIGEST, DONE, FLAG_PARITY, GROUP, GROUP_BODY,
+                          HELLO, HELLO_BODY, JOIN, MAX_RUN_BLOCKS, PROTOCOL_VERSION, REQUEST, REQUEST_BODY, RUN_SHIFT,
+                          SEGMENT, SEGMENT_BODY, WELCOME, WELCOME_BODY, DataHeader, ProtocolError, RefusedError,
+                          load_legacy, negotiate_block_size, pack_message, pack_nack, recv_message, split_messages,
+                          xor_blocks)
+
+
+def path_block_size(server_name):
+    """
+    Picks the largest block size whose datagrams cross the path to the server without IP fragmentation
+    
+    :param server_name: IP address of the server
+    :return: block size to ask the server for
+    """
+    # only Linux tells the MTU of a path, as IP_MTU of a connected socket
+    if not sys.platform.startswith('linux'):
+        return BLOCK_SIZE
+    
+    probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    
+    try:
+        probe.connect((server_name, 9))
+        mtu = probe.getsockopt(socket.IPPROTO_IP, getattr(socket, 'IP_MTU', 14))
+    except OSError:
+        return BLOCK_SIZE
+    finally:
+        probe.close()
+    
+    # IPv4 and UDP headers, and the data header of the current version
+    payload = mtu - 28 - DataHeader(PROTOCOL_VERSION).size
+    return negotiate_block_size(payload)
+
 
 class MainClientSession(object):
     """The main session running on the client side"""
     
+    # seconds to wait for the answer to the HELLO message, given right away by every server but those of the original
+    # protocol
+    hello_timeout = 5
+    
     # noinspection PyShadowingNames
-    def __init__(self, client_name, client_udp_port, server_name, server_tcp_port, filename, num_threads):
+    def __init__(self, client_name, client_udp_port, server_name, server_tcp_port, filename, num_threads,
+                 batch_size, block_size = 0, multicast = False):
         """
         :param client_name: IP address of the client
-        :param client_udp_port: starting UDP port number of the client receiving data
+        :param client_udp_port: UDP port number of the client receiving data, 0 for an ephemeral one
         :param server_name: IP address of the server
         :param server_tcp_port: TCP port number of the server listening to clients' connections
         :param filename: name of the file requested by the client
         :param num_threads: number of threads intended to use
+        :param batch_size: kilobytes taken from the kernel per system call
+        :param block_size: bytes of file data per datagram asked for, 0 for the most the path to the server carries
+        :param multicast: True to join a multicast session, receiving the blocks the server sends to a group
         """
         self.client_tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.client_name = client_name
@@ -32,7 +81,18 @@ class MainClientSession(object):
         self.new_server_tcp_port = None
         self.filename = filename
         self.num_threads = str(num_threads)
+        self.batch_size = batch_size
+        self.block_size = int(block_size) or path_block_size(server_name)
+        self.multicast = multicast
+        # (IP address, port) of the group of a multicast session, and the size of the file and of its segments
+        self.group = None
+        self.group_layout = None
+        self.header = None
         self.server_md5 = None
+        self.scheduler = None
+        self.output_file = None
+        self.journal = None
+        self.threads = []
         
         self.initialize_connection()
     
@@ -45,49 +105,220 @@ class MainClientSession(object):
         self.client_tcp_socket.connect((self.server_name, self.server_tcp_port))
         print("Client: Successfully connected to server")
         
+        # send over the highest header version understood, the number of threads, the block size wished for and the
+        # filename to the main server session, asking to join a multicast session if told to
+        hello = HELLO_BODY.pack(PROTOCOL_VERSION, int(self.num_threads), self.block_size)
+        self.client_tcp_socket.sendall(pack_message(JOIN if self.multicast else HELLO,
+                                                    hello + self.filename.encode('utf-8')))
+        print('Client: Download will be in {} threads'.format(self.num_threads))
+        
+        # receives the server TCP port number exclusively created for this client session, the header version and the
+        # block size; servers of the original protocol cannot parse the HELLO message, and never answer
+        self.client_tcp_socket.settimeout(self.hello_timeout)
+        
+        try:
+            welcome = recv_message(self.client_tcp_socket, GROUP if self.multicast else WELCOME)
+        except socket.timeout:
+            if self.multicast:
+                raise ConnectionError('Server does not serve files by multicast')
+            
+            print('Client: Server speaks the original protocol, connecting again')
+            self.initialize_legacy_connection()
+            return
+        
+        self.client_tcp_socket.settimeout(None)
+        
+        # followed by the group the blocks are sent to for a multicast session
+        if self.multicast:
+            self.new_server_tcp_port, version, block_size, group, group_port, file_size, segment_size = \
+                GROUP_BODY.unpack(welcome)
+            self.group = (socket.inet_ntoa(group), group_port)
+            self.group_layout = (file_size, segment_size)
+        else:
+            self.new_server_tcp_port, version, block_size = WELCOME_BODY.unpack(welcome)
+        
+        self.header = DataHeader(version, block_size)
+        
+        # receives the root of the hash tree over the pieces of the original file, once the server has hashed it
+        self.server_md5 = recv_message(self.client_tcp_socket, DIGEST)
+    
+    def initialize_legacy_connection(self):
+        """Communicates the necessary information with a server of the original protocol, pickled"""
+        self.client_tcp_socket.close()
+        self.client_tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.client_tcp_socket.connect((self.server_name, self.server_tcp_port))
+        
         # send over the number of threads and filename to the main server session
         self.client_tcp_socket.send(pickle.dumps((self.num_threads, self.filename)))
-        print('Client: Download will be in {} threads'.format(self.num_threads))
         
         # receives the server TCP port number exclusively created for this client session
-        self.new_server_tcp_port = pickle.loads(self.client_tcp_socket.recv(1024))
+        message = self.client_tcp_socket.recv(1024)
+        stream = io.BytesIO(message)
+        self.new_server_tcp_port = load_legacy(stream)
+        self.header = DataHeader(1)
+        
+        # receives the checksum of the original file from the server side, which may come in the same read
+        self.server_md5 = message[stream.tell():]
         
-        # receives the checksum of the original file from the server side
-        self.server_md5 = self.client_tcp_socket.recv(1024)
+        while len(self.server_md5) < 16:
+            data = self.client_tcp_socket.recv(16 - len(self.server_md5))
+            
+            if not data:
+                raise ConnectionError('Server closed the connection during handshake')
+            
+            self.server_md5 += data
     
     def receive_data(self):
-        """The main method handling the download session on client side"""
+        """
+        The main method handling the download session on client side
+        
+        :return: True if the whole file was downloaded and passes the checksum
+        """
+        start_time = time.time()
         self.do_threading()
-        self.combine_segments()
         
-        print('\n' * (int(self.num_threads) - 1))   # avoid line conflict with thread-level pbars
-        print('File passes checksum!' if self.is_correct() else 'File is corrupted!')
+        # the threads write straight into the output file, but for the original protocol
+        if self.header.version == 1:
+            self.combine_segments()
+        
+        # every segment is complete and verified, nothing left to resume; the journal is kept if the server hung up
+        # before that
+        correct = self.is_correct()
+        
+        if self.journal is not None and correct:
+            self.journal.remove()
+        
+        end_time = time.time()
+        self.scheduler.pbar.close()
+        
+        # segments are shared by the threads that finish them, so corruption is told for the whole session
+        corrupted_pieces = sum(segment.corrupted_pieces for segment in self.scheduler.segments.values())
+        
+        # threads left without a segment have nothing to tell
+        for thread in self.threads:
+            if thread.requested:
+                thread.show_summary(thread.thread_num, start_time, end_time, thread.packet_loss, thread.requested,
+                                    thread.repair_rounds, corrupted_pieces)
+        
+        print('File passes checksum!' if correct else 'File is corrupted!')
+        
+        if self.journal is not None and not correct:
+            print('Client: Download kept in {} to be resumed'.format(self.journal.path))
+        
+        return correct
     
     def do_threading(self):
-        """Creates and ends all threads"""
-        # a Lock object is used to prevent mixed up printing on different threads
-        lock = threading.Lock()
-        
-        # create threads
-        for i in range(int(self.num_threads)):
-            thread = ThreadedClientSession(self.client_name, self.client_udp_port,
-                                           self.server_name, self.new_server_tcp_port,
-                                           self.filename, lock)
+        """Creates all threads and drives them from one selector until every segment is downloaded"""
+        selector = selectors.DefaultSelector()
+        demultiplexer = None
+        self.scheduler = scheduler = SegmentScheduler(self.header, int(self.num_threads))
+        
+        # headers carrying a stream ID let all threads share one UDP socket, older ones need a socket per thread
+        if self.header.version > 1:
+            demultiplexer = StreamDemultiplexer(self.client_name, self.client_udp_port, self.header, self.batch_size,
+                                                int(self.num_threads), scheduler)
             
-            t = threading.Thread(target = thread.request_segment,
-                                 kwargs = {'thread_num': i + 1})
+            # repairs still come by unicast
+            if self.group is not None:
+                demultiplexer.join_group(*self.group)
+        
+        # the server tells each thread where its segment goes in the file, and lets the threads skip the blocks they
+        # already have
+        if self.header.version > 1:
+            self.journal = DownloadJournal('download_' + self.filename + '.journal', self.server_md5,
+                                           self.header.block_size)
+            resume = os.path.exists('download_' + self.filename) and self.journal.load()
+            
+            if resume:
+                print('Client: Resuming the download')
+            else:
+                self.journal.reset()
             
-            t.setDaemon(True)
-            t.start()
+            self.output_file = open('download_' + self.filename, 'r+b' if resume else 'w+b')
         
-        main_thread = threading.current_thread()
+        if self.group is not None:
+            self.expect_segments(*self.group_layout)
         
-        # end threads
-        for thread in threading.enumerate():
-            if thread is main_thread:
-                continue
-            
-            thread.join()
+        self.threads = threads = [ThreadedClientSession(self.client_name, self.client_udp_port,
+                                                        self.server_name, self.new_server_tcp_port,
+                                                        self.filename, self.header, self.batch_size, i + 1,
+                                                        scheduler, demultiplexer, self.output_file, self.journal)
+                                  for i in range(int(self.num_threads))]
+        
+        # connect every thread first so that the wait for the server is only paid once
+        for thread in threads:
+            thread.connect_thread_sockets()
+        
+        # servers of the original protocol need the thread's address and its first request in separate reads
+        if self.header.version == 1:
+            time.sleep(.1)
+        
+        for thread in threads:
+            thread.request_segment(selector)
+        
+        scheduler.start_progress(self.journal.count() if self.journal is not None else 0)
+        
+        # the threads report lost blocks as they go
+        timeout = ThreadedClientSession.sack_interval if self.header.version > 1 else None
+        
+        last_sack = time.time()
+        
+        try:
+            # wait on the control and data sockets of all threads together, so nothing spins while idle
+            while selector.get_map():
+                events = selector.select(timeout)
+                # handle datagrams before control messages, so a DONE is judged against everything already queued
+                events.sort(key = lambda event: event[0].data[1] == 'control')
+                
+                for key, _ in events:
+                    thread, kind = key.data
+                    
+                    if kind == 'data':
+                        thread.receive_packets()
+                    else:
+                        thread.handle_control(selector)
+                
+                if self.header.version > 1 and time.time() - last_sack >= ThreadedClientSession.sack_interval:
+                    for thread in threads:
+                        thread.send_sack()
+                    
+                    last_sack = time.time()
+                
+                if self.journal is not None and self.journal.is_due():
+                    self.journal.checkpoint(self.output_file, scheduler.segments.values())
+        finally:
+            # keep what was downloaded if the client is interrupted
+            if self.journal is not None:
+                self.journal.checkpoint(self.output_file, scheduler.segments.values(), wait = True)
+        
+        selector.close()
+        
+        if self.output_file is not None:
+            self.output_file.close()
+        else:
+            for segment in scheduler.segments.values():
+                segment.segment_file.close()
+    
+    def expect_segments(self, file_size, segment_size):
+        """
+        Sets up every segment of a multicast session before any is requested, so that the blocks the server sends to
+        the group for the other receivers are saved as well
+        
+        :param file_size: size of the file
+        :param segment_size: size of every segment but the last
+        """
+        block_size = self.header.block_size
+        self.scheduler.learn_file(file_size, (file_size + segment_size - 1) // segment_size)
+        ThreadedClientSession.preallocate(self.output_file, file_size)
+        
+        for segment_num in range(1, self.scheduler.segment_count + 1):
+            offset = (segment_num - 1) * segment_size
+            blocks = (min(segment_size, file_size - offset) + block_size - 1) // block_size
+            received = BlockBitmap(blocks, self.journal.segment_bits(offset, blocks)
+                                   if self.journal is not None else None)
+            # the digests of the segment's pieces come with the answer to its request
+            self.scheduler.segments[segment_num] = SegmentDownload(segment_num, received, offset, None,
+                                                                   self.output_file, self.header)
     
     def combine_segments(self):
         """Combines the thread-downloaded segments in the correct sequence to get the whole file"""
@@ -106,121 +337,770 @@ class MainClientSession(object):
         # clean up the segments
         [os.remove(segment) for segment in file_list]
         return
-
+    
     def is_correct(self):
         """Implements a MD5 checksum on the client's whole file and compares against the server's"""
+        # every piece was checked against its digest as it completed, only the digests are left to check
+        if self.header.version > 1:
+            segments = [self.scheduler.segments[num] for num in sorted(self.scheduler.segments)]
+            leaves = [leaf for segment in segments for leaf in segment.leaves or []]
+            return all(segment.is_complete() for segment in segments) and self.server_md5 == merkle_root(leaves)
+        
         client_md5 = hashlib.md5()
-    
+        
         with open('download_' + self.filename, 'rb') as f:
             for chunk in iter(lambda: f.read(4096), b''):
                 client_md5.update(chunk)
-    
+        
         return self.server_md5 == client_md5.digest()
+
+
+class SegmentScheduler(object):
+    """
+    Hands out the segments of the file to the client threads one at a time, as they become free
+    
+    Servers split the file into many more segments than there are threads, so threads that are done early take the
+    segments that are left instead of waiting for the slower ones. Once every segment has been handed out, free threads
+    help with the unfinished segment missing the most blocks. Servers of the original protocol cut the file in one
+    segment per thread
+    """
+    
+    # threads downloading the same segment at most
+    max_workers = 2
+    
+    def __init__(self, header, num_threads):
+        """
+        :param header: DataHeader negotiated with the server
+        :param num_threads: number of threads downloading the file
+        """
+        self.header = header
+        self.num_threads = num_threads
+        # SegmentDownloads by segment number
+        self.segments = {}
+        # every thread starts on the segment of its number, servers of the original protocol cut the file in exactly
+        # that many
+        self.unassigned = deque(range(1, num_threads + 1))
+        # number of segments and size of the file, as given by the server
+        self.segment_count = None
+        self.file_size = 0
+        self.pbar = None
+    
+    def learn_file(self, file_size, segment_count = None):
+        """Records what the server tells about the file, queueing the segments no thread has started on"""
+        self.file_size = file_size
+        
+        if segment_count is None or self.segment_count is not None:
+            return
+        
+        self.segment_count = segment_count
+        self.unassigned.extend(range(self.num_threads + 1, segment_count + 1))
+        
+        # the progress bar may be shown before the answer to the first segment request comes in
+        if self.pbar is not None:
+            self.pbar.total = self.file_blocks() * self.header.block_size
+            self.pbar.refresh()
+    
+    def next_segment(self, thread):
+        """
+        :param thread: ThreadedClientSession free to download a segment
+        :return: number of the segment it should download next, None if there is nothing left for it
+        """
+        if self.unassigned:
+            return self.unassigned.popleft()
+        
+        if self.header.version == 1:
+            return None
+        
+        # a second stream on a segment is worth it only if it has whole pieces left for each stream
+        candidates = [segment for segment in self.segments.values()
+                      if len(segment.workers) < self.max_workers and thread not in segment.workers
+                      and segment.missing_blocks() >= self.header.piece_blocks * (len(segment.workers) + 1)]
+        
+        if not candidates:
+            return None
+        
+        return max(candidates, key = lambda segment: segment.missing_blocks() / len(segment.workers)).segment_num
+    
+    def save_packets(self, segment_num, datagrams):
+        """Saves the datagrams of a segment and advances the progress bar"""
+        segment = self.segments.get(segment_num)
+        
+        # drop stray datagrams of a segment never requested
+        if segment is not None:
+            self.pbar.update(segment.save_packets(datagrams) * self.header.block_size)
+    
+    def start_progress(self, initial):
+        """
+        Shows one progress bar for the whole download
+        
+        :param initial: number of blocks saved by an interrupted run of the download
+        """
+        # counted in blocks, shown in bytes, and sized once the server tells the size of the file
+        total = self.file_blocks()
+        self.pbar = tqdm(total = total * self.header.block_size if total is not None else None,
+                         initial = initial * self.header.block_size, unit = 'B', unit_scale = True, unit_divisor = 1024)
+    
+    def file_blocks(self):
+        """
+        :return: number of blocks in the file, None until the server tells the size of the file
+        """
+        # servers of the original protocol do not tell the size of the file, every segment has been requested then
+        if self.header.version == 1:
+            return sum(segment.received.size for segment in self.segments.values())
+        
+        if self.segment_count is None:
+            return None
+        
+        return (self.file_size + self.header.block_size - 1) // self.header.block_size
+
+
+class StreamDemultiplexer(object):
+    """One UDP socket shared by all threads of a session, handing each datagram to the segment of its stream ID"""
+    
+    def __init__(self, client_name, client_udp_port, header, batch_size, num_threads, scheduler):
+        """
+        :param client_name: IP address of the client
+        :param client_udp_port: UDP port number receiving the data of every thread, 0 for an ephemeral one
+        :param header: DataHeader negotiated with the server
+        :param batch_size: kilobytes taken from the kernel per system call
+        :param num_threads: number of threads sharing the socket
+        :param scheduler: SegmentScheduler holding the segments being downloaded
+        """
+        self.client_name = client_name
+        self.header = header
+        self.batch_size = header.datagrams_for(batch_size * BLOCK_SIZE)
+        self.num_threads = num_threads
+        self.scheduler = scheduler
+        self.udp_socket = self.open_socket((client_name, client_udp_port))
+        self.receiver = BatchReceiver(self.udp_socket, self.batch_size, header.size + header.block_size)
+        # socket and receiver of the multicast group, if any
+        self.group_socket = None
+        self.group_receiver = None
+        # threads still downloading
+        self.threads = set()
+    
+    def open_socket(self, address):
+        """
+        :param address: (IP address, port) to receive on
+        :return: non-blocking UDP socket bound to the address
+        """
+        udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # queue as much as the sockets of the threads would have together, and as many datagrams whatever the block
+        # size, the kernel caps it at rmem_max
+        buffer_size = udp_socket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                              buffer_size * self.num_threads * max(1, self.header.block_size // BLOCK_SIZE))
+        udp_socket.bind(address)
+        udp_socket.setblocking(False)
+        return udp_socket
+    
+    def join_group(self, group, port):
+        """
+        Also receives the datagrams sent to a multicast group, on the interface of the client's IP address
+        
+        :param group: IP address of the group
+        :param port: port the group's datagrams are sent to
+        """
+        # bound to the group address, so that only the group's datagrams come in, however many receivers share the port
+        self.group_socket = self.open_socket((group, port))
+        self.group_socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                                     socket.inet_aton(group) + socket.inet_aton(self.client_name))
+        self.group_receiver = BatchReceiver(self.group_socket, self.batch_size,
+                                            self.header.size + self.header.block_size)
+    
+    def attach(self, thread, selector):
+        """Starts receiving data for the thread"""
+        if not self.threads:
+            selector.register(self.udp_socket, selectors.EVENT_READ, (self, 'data'))
+            
+            if self.group_socket is not None:
+                selector.register(self.group_socket, selectors.EVENT_READ, (self, 'data'))
+        
+        self.threads.add(thread)
+    
+    def detach(self, thread, selector):
+        """Stops receiving data for the thread, closing the sockets once no thread is left"""
+        self.threads.discard(thread)
+        
+        if not self.threads:
+            selector.unregister(self.udp_socket)
+            self.udp_socket.close()
+            
+            if self.group_socket is not None:
+                selector.unregister(self.group_socket)
+                self.group_socket.close()
     
+    def receive_packets(self):
+        """Receives the packets queued on the UDP sockets and passes them on to their segments"""
+        streams = {}
+        datagrams = self.receiver.recv()
+        
+        if self.group_receiver is not None:
+            datagrams += self.group_receiver.recv()
+        
+        for data in datagrams:
+            fields = self.header.unpack(data)
+            
+            # drop stray datagrams of another header version
+            if fields is not None:
+                streams.setdefault(fields[1], []).append(data)
+        
+        for stream, datagrams in streams.items():
+            self.scheduler.save_packets(stream, datagrams)
+
+
+class SegmentDownload(object):
+    """A segment of the file being downloaded, by one thread or by two once no segment is left to hand out"""
+    
+    def __init__(self, segment_num, received, offset, leaves, segment_file, header):
+        """
+        :param segment_num: number of the segment, also the stream ID of its datagrams
+        :param received: BlockBitmap of the blocks of the segment saved so far
+        :param offset: offset of the segment in the file
+        :param leaves: digests of the segment's pieces, empty for the original protocol, None until the segment is
+        requested
+        :param segment_file: file the segment is saved to
+        :param header: DataHeader negotiated with the server
+        """
+        self.segment_num = segment_num
+        self.received = received
+        self.offset = offset
+        self.leaves = leaves
+        self.segment_file = segment_file
+        self.header = header
+        # threads downloading the segment
+        self.workers = []
+        self.corrupted_pieces = 0
+        # highest block saved in the current round, and the block up to which the gaps have been reported
+        self.highest = -1
+        self.reported = 0
+        # most blocks covered by a parity block of the segment so far
+        self.parity_span = 0
+        
+        # number of blocks each piece still misses
+        piece_blocks = header.piece_blocks
+        self.pending = [0] * ((received.size + piece_blocks - 1) // piece_blocks)
+        
+        for start, end in received.missing_ranges():
+            while start < end:
+                piece_end = min(end, (start // piece_blocks + 1) * piece_blocks)
+                self.pending[start // piece_blocks] += piece_end - start
+                start = piece_end
+    
+    def missing_blocks(self):
+        return self.received.size - self.received.count
+    
+    def later_half(self):
+        """
+        :return: sorted list of (start, end) ranges of the later half of the missing blocks, end exclusive
+        """
+        half = self.missing_blocks() // 2
+        ranges = []
+        
+        for start, end in reversed(self.received.missing_ranges()):
+            if half <= 0:
+                break
+            
+            start = max(start, end - half)
+            ranges.insert(0, (start, end))
+            half -= end - start
+        
+        return ranges
+    
+    def new_round(self):
+        """Starts tracking the blocks of a round of retransmission, sent in order like the first one"""
+        self.highest = -1
+        self.reported = 0
+    
+    def unreported_gaps(self):
+        """
+        :return: sorted list of (start, end) ranges of the blocks lost in the current round and not reported yet
+        """
+        # blocks arriving a piece behind the highest one of the round are taken as lost rather than late, or once the
+        # parity that could rebuild them is past
+        end = self.highest - max(self.header.piece_blocks, self.parity_span)
+        
+        if end <= self.reported:
+            return []
+        
+        gaps = [(max(start, self.reported), min(stop, end)) for start, stop in self.received.missing_ranges()
+                if start < end and stop > self.reported]
+        self.reported = end
+        return gaps
+    
+    def is_complete(self):
+        # each piece is verified as its last block comes in
+        return self.received.is_complete()
+    
+    def save_packets(self, datagrams):
+        """
+        Saves the segment's datagrams, verifying the pieces they complete
+        
+        :return: change in the number of blocks saved
+        """
+        count = self.received.count
+        
+        for datagram in datagrams:
+            fields = self.header.unpack(datagram)
+            
+            if fields is not None and fields[2] & FLAG_PARITY:
+                blocks = self.recover(fields, datagram)
+            elif fields is not None and fields[2] & CODEC_MASK:
+                blocks = self.decompress(fields, datagram)
+            else:
+                blocks = [datagram]
+            
+            for data in blocks:
+                segment_id = self.save_packet(self.segment_file, data, self.received, self.header, self.segment_num,
+                                              self.offset)
+                
+                if segment_id is None:
+                    continue
+                
+                if segment_id > self.highest:
+                    self.highest = segment_id
+                
+                piece = segment_id // self.header.piece_blocks
+                self.pending[piece] -= 1
+                
+                if self.pending[piece] == 0 and self.leaves:
+                    self.verify_piece(piece)
+        
+        return self.received.count - count
+    
+    def decompress(self, fields, datagram):
+        """
+        Splits a datagram of blocks compressed together back into one datagram per block
+        
+        :param fields: (index of the first block, stream, flags) of the datagram
+        :param datagram: the datagram
+        :return: list of the datagrams of the blocks, empty if it is corrupted and must be asked for again
+        """
+        start, stream, flags = fields
+        block_size = self.header.block_size
+        count = ((flags >> RUN_SHIFT) & (MAX_RUN_BLOCKS - 1)) + 1
+        
+        # a run past the end of the segment is bogus
+        if start + count > self.received.size:
+            return []
+        
+        try:
+            data = decompress_blocks(flags & CODEC_MASK, datagram[self.header.size:], count * block_size)
+        except ValueError:
+            return []
+        
+        # only the last block of the file is not full
+        if (len(data) + block_size - 1) // block_size != count:
+            return []
+        
+        return [self.header.pack(start + i, stream) + data[i * block_size:(i + 1) * block_size] for i in range(count)]
+    
+    def recover(self, fields, datagram):
+        """
+        Rebuilds the block lost from the window covered by a parity block
+        
+        :param fields: (index of the first block covered, stream, flags) of the parity block
+        :param datagram: the parity block
+        :return: list of the datagram of the block rebuilt, empty unless exactly one block of the window is missing
+        """
+        start, stream, flags = fields
+        count = (flags & ~FLAG_PARITY) + 1
+        self.parity_span = max(self.parity_span, count)
+        
+        if stream != self.segment_num or start >= self.received.size:
+            return []
+        
+        missing = [idx for idx in range(start, min(start + count, self.received.size)) if idx not in self.received]
+        
+        if len(missing) != 1:
+            return []
+        
+        block_size = self.header.block_size
+        fd = self.segment_file.fileno()
+        blocks = [os.pread(fd, block_size, self.offset + idx * block_size)
+                  for idx in range(start, min(start + count, self.received.size)) if idx != missing[0]]
+        # the parity is padded to the block size, the last block of the file is not; the output file is sized to it
+        position = self.offset + missing[0] * block_size
+        length = min(block_size, os.fstat(fd).st_size - position)
+        return [self.header.pack(missing[0], stream) + xor_blocks(blocks + [datagram[self.header.size:]],
+                                                                  block_size)[:length]]
+    
+    def learn_leaves(self, leaves):
+        """Records the digests of the segment's pieces, verifying the pieces completed before they were known"""
+        self.leaves = leaves
+        
+        for piece, pending in enumerate(self.pending):
+            if pending == 0:
+                self.verify_piece(piece)
+    
+    def verify_piece(self, piece):
+        """Checks a completed piece against its digest, forgetting its blocks so that they are requested again if bad"""
+        block_size = self.header.block_size
+        start = piece * self.header.piece_blocks
+        end = min(start + self.header.piece_blocks, self.received.size)
+        
+        data = os.pread(self.segment_file.fileno(), (end - start) * block_size, self.offset + start * block_size)
+        
+        if hashlib.md5(data).digest() == self.leaves[piece]:
+            return
+        
+        self.corrupted_pieces += 1
+        self.received.clear(start, end)
+        self.pending[piece] = end - start
+    
+    @staticmethod
+    def save_packet(file, segment, received, header, segment_num, offset = 0):
+        """
+        Saves the received packets onto the storage instantly to prevent memory hogging
+        
+        :param offset: offset of the segment in the file
+        :return: ID of the block saved, None if the datagram was dropped or the block was already saved
+        """
+        fields = header.unpack(segment)
+        
+        # drop stray datagrams of another header version or of another segment
+        if fields is None or (header.version > 1 and fields[1] != segment_num):
+            return
+        
+        segment_id = fields[0]
+        
+        # drop blocks past the end of the segment, which no server sends
+        if segment_id >= received.size:
+            return
+        
+        # keep track of the received packets and prevent repetitive writing
+        if received.mark(segment_id):
+            # offsets the previous packets
+            os.pwrite(file.fileno(), segment[header.size:], offset + segment_id * header.block_size)
+            return segment_id
+
 
 class ThreadedClientSession(object):
-    """The thread session for actual downloading"""
+    """The thread session for actual downloading, driven by the selector of MainClientSession"""
+    
+    # seconds between reports of the blocks lost during a round
+    sack_interval = 0.01
     
-    def __init__(self, client_name, client_udp_port, server_name, new_server_tcp_port, filename, lock):
+    def __init__(self, client_name, client_udp_port, server_name, new_server_tcp_port, filename, header, batch_size,
+                 thread_num, scheduler, demultiplexer = None, output_file = None, journal = None):
         """
         :param client_name: IP address of the client
-        :param client_udp_port: UDP port number of the client's thread receiving data
+        :param client_udp_port: UDP port number of the client receiving data, 0 for an ephemeral one
         :param server_name: IP address of the server
         :param new_server_tcp_port: TCP port number of the server connected to this client
-        :param filename: name of the file segment requested by the thread
-        :param lock: Lock object controlling printing behaviour
+        :param filename: name of the file whose segments are requested by the thread
+        :param header: DataHeader negotiated with the server
+        :param batch_size: kilobytes taken from the kernel per system call
+        :param thread_num: ID of this thread
+        :param scheduler: SegmentScheduler handing out the segments
+        :param demultiplexer: StreamDemultiplexer receiving the data of this thread, None for a socket of its own
+        :param output_file: downloaded file shared by all threads, None to save each segment to a file of its own
+        :param journal: DownloadJournal of the download, None if it cannot be resumed
         """
         self.client_name = client_name
         self.client_udp_port = client_udp_port
         self.server_name = server_name
         self.new_server_tcp_port = new_server_tcp_port
         self.filename = filename
-        self.lock = lock
+        self.header = header
+        self.batch_size = header.datagrams_for(batch_size * BLOCK_SIZE)
+        self.thread_num = thread_num
+        self.scheduler = scheduler
+        self.demultiplexer = demultiplexer
+        self.output_file = output_file
+        self.journal = journal
+        self.thread_tcp_socket = None
+        self.thread_udp_socket = None
+        self.receiver = None
+        # control messages received only in part
+        self.control_buffer = b''
+        # SegmentDownload the thread is working on
+        self.segment = None
+        self.registered = False
+        # datagrams asked for in every round and report, those lost, each once per round, and rounds sent again for
+        # lost blocks
+        self.requested = 0
+        self.packet_loss = 0
+        self.repair_rounds = 0
+        # (start, end) ranges of the blocks asked for in the current round
+        self.round_ranges = []
+        # number of the segment requested and not answered yet
+        self.requesting = None
     
-    def request_segment(self, thread_num):
+    def request_segment(self, selector):
         """
-        Downloads the segment from the server
+        Requests the next segment from the server, finishing the thread once there is none left for it
         
-        :param thread_num: ID of this thread
+        Servers of the original protocol answer before this returns, which only happens before any data is sent. Others
+        answer in a SEGMENT message handled by handle_control, so that the data of the other threads keeps being
+        received meanwhile
+        
+        :param selector: selector of the main session
         """
-        name, ext = os.path.splitext(self.filename)
+        self.thread_tcp_socket.setblocking(True)
         
-        # name of the segment requested by this thread
-        segment_name = "{0}_{1}{2}".format(name, thread_num, ext)
-        # name of the segment saved on the client
-        saved_name = os.path.splitext(segment_name)[0] + '_copy' + os.path.splitext(segment_name)[1]
+        while True:
+            segment_num = self.scheduler.next_segment(self)
+            
+            if segment_num is None:
+                self.finish(selector)
+                return
+            
+            self.send_request(segment_num)
+            
+            if self.header.version > 1:
+                self.requesting = segment_num
+                break
+            
+            if self.start_segment(segment_num, *self.receive_segment_info()):
+                break
         
-        # initialize thread-level connection
-        thread_tcp_socket, thread_udp_socket = self.connect_thread_sockets(thread_num)
+        self.thread_tcp_socket.setblocking(False)
         
-        # wait to establish the connection
-        time.sleep(.1)
-        # send over the segment name
-        thread_tcp_socket.send(segment_name.encode('utf-8'))
+        if self.registered:
+            return
+        
+        if self.demultiplexer is None:
+            self.thread_udp_socket.setblocking(False)
+            self.receiver = BatchReceiver(self.thread_udp_socket, self.batch_size,
+                                          self.header.size + self.header.block_size)
+            selector.register(self.thread_udp_socket, selectors.EVENT_READ, (self, 'data'))
+        else:
+            self.demultiplexer.attach(self, selector)
+        
+        selector.register(self.thread_tcp_socket, selectors.EVENT_READ, (self, 'control'))
+        self.registered = True
+    
+    def send_request(self, segment_num):
+        """
+        Asks the server for a segment
+        
+        :param segment_num: number of the segment
+        """
+        # send over the segment number, or its name to servers of the original protocol
+        if self.header.version == 1:
+            name, ext = os.path.splitext(self.filename)
+            self.thread_tcp_socket.send("{0}_{1}{2}".format(name, segment_num, ext).encode('utf-8'))
+        else:
+            self.thread_tcp_socket.sendall(pack_message(REQUEST, REQUEST_BODY.pack(segment_num)))
+    
+    def start_segment(self, segment_num, blocks, offset, leaves):
+        """
+        Starts downloading a segment once the server answered its request
+        
+        :param segment_num: number of the segment
+        :param blocks: number of blocks in the segment, 0 if the server cannot serve it
+        :param offset: offset of the segment in the file
+        :param leaves: digests of the segment's pieces
+        :return: True if the server is sending the segment, False if it is empty or cannot be served
+        """
+        name, ext = os.path.splitext(self.filename)
         
-        # receive the segment size in Kb
-        blocks = int(thread_tcp_socket.recv(1024).decode('utf-8'))
         if blocks == 0:
-            print("Client: File does not exist. Please try again :(")
-        
-        thread_tcp_socket.setblocking(False)
-        thread_udp_socket.settimeout(.1)
-        
-        # start_time = time.time()
-        packet_loss = 0
-        transmission_count = 0
-        segment_id_list = []
-        segment_file = open(saved_name, 'wb')
-        
-        with tqdm(total = blocks, unit = 'KB', unit_scale = True, unit_divisor = 1024,
-                  position = thread_num - 1) as pbar:
-            while True:
-                while True:
-                    try:
-                        # check if the transmission is done
-                        if thread_tcp_socket.recv(1024).decode('utf-8') == 'DONE':
-                            transmission_count += 1
-                            break
-                    
-                    except socket.error:
-                        # if not done, continue with the UDP transmission
-                        pass
-                    
-                    try:
-                        # receive and save the packets
-                        data, _ = thread_udp_socket.recvfrom(1026)
-                        segment_id_list = self.save_packet(segment_file, data, segment_id_list)
-                        
-                        pbar.update(1)
-                    except socket.error:
-                        pass
-                
-                # check for missing packets
-                missing = self.missing_elements(sorted(segment_id_list), 0, blocks - 1)
+            # segments of files smaller than a piece per thread may be empty, and servers handing out segments on
+            # demand tell how many there are only once asked for one
+            if self.scheduler.segment_count is None or segment_num <= self.scheduler.segment_count:
+                print("Client: Segment {} is empty or the file does not exist".format(segment_num))
+            return False
+        
+        segment = self.scheduler.segments.get(segment_num)
+        
+        if segment is None:
+            # blocks already saved by an interrupted run of the download are not requested again
+            received = BlockBitmap(blocks, self.journal.segment_bits(offset, blocks)
+                                   if self.journal is not None else None)
+            
+            if self.output_file is not None:
+                segment_file = self.output_file
+                self.preallocate(segment_file, self.scheduler.file_size)
+            else:
+                # read back to verify each piece once all its blocks are in
+                segment_file = open("{0}_{1}_copy{2}".format(name, segment_num, ext), 'w+b')
+            
+            segment = SegmentDownload(segment_num, received, offset, leaves, segment_file, self.header)
+            self.scheduler.segments[segment_num] = segment
+            first_round = received.missing_ranges()
+        elif segment.leaves is None:
+            # segment of a multicast session, whose blocks may have come in while they were sent to other receivers
+            segment.learn_leaves(leaves)
+            first_round = segment.received.missing_ranges()
+        else:
+            # help the thread already on the segment, which sends the blocks in order, by taking the later ones
+            first_round = segment.later_half()
+        
+        # ask for the blocks of the first round, servers of the original protocol send them all
+        if self.header.version > 1:
+            self.thread_tcp_socket.sendall(pack_nack(first_round))
+        
+        segment.workers.append(self)
+        self.segment = segment
+        self.requested += sum(end - start for start, end in first_round)
+        self.round_ranges = first_round
+        return True
+    
+    def receive_segment_info(self):
+        """
+        Receives the answer of a server of the original protocol to the segment request, the number of blocks as text
+        
+        :return: (number of blocks in the segment, 0 if the server cannot serve it, offset of the segment, digests of
+        its pieces)
+        """
+        return int(self.thread_tcp_socket.recv(1024).decode('utf-8')), 0, []
+    
+    def parse_segment_info(self, message):
+        """
+        :param message: body of the SEGMENT message answering the segment request
+        :return: (number of blocks in the segment, 0 if the server cannot serve it, offset of the segment, digests of
+        its pieces)
+        """
+        blocks, offset, file_size, segment_count = SEGMENT_BODY.unpack_from(message)
+        self.scheduler.learn_file(file_size, segment_count)
+        leaves = message[SEGMENT_BODY.size:]
+        return blocks, offset, [leaves[i:i + 16] for i in range(0, len(leaves), 16)]
+    
+    def receive_packets(self):
+        """Receives and saves the packets queued on the UDP socket"""
+        if self.demultiplexer is not None:
+            self.demultiplexer.receive_packets()
+            return
+        
+        self.scheduler.save_packets(self.segment.segment_num, self.receiver.recv())
+    
+    def handle_control(self, selector):
+        """
+        Answers the DONE signals sent by the server at the end of each round of transmission, and starts on the
+        segments it answers requests for
+        
+        :param selector: selector of the main session
+        """
+        message = self.thread_tcp_socket.recv(1024)
+        
+        # the server hung up
+        if not message:
+            self.finish(selector)
+            return
+        
+        # DONE signals of consecutive rounds may arrive together, one answer covers all of them
+        if self.header.version == 1:
+            if b'DONE' not in message:
+                return
+        else:
+            messages, self.control_buffer = split_messages(self.control_buffer + message)
+            
+            if not messages:
+                return
+            
+            # nothing else comes before the thread asks for the blocks of the segment
+            if self.requesting is not None:
+                if len(messages) != 1 or messages[0][0] != SEGMENT:
+                    raise ProtocolError('Server sent an unexpected message instead of a segment')
                 
-                # terminates the download process if all packets are received
-                if len(missing) == 0:
-                    break
+                segment_num, self.requesting = self.requesting, None
+                self.thread_tcp_socket.setblocking(True)
                 
+                if self.start_segment(segment_num, *self.parse_segment_info(messages[0][1])):
+                    self.thread_tcp_socket.setblocking(False)
                 else:
-                    packet_loss += len(missing)
-                    missing_bytes = b''
-                    
-                    for idx in missing:
-                        missing_bytes += idx.to_bytes(2, byteorder = 'big')
-                    
-                    # send over the ID of the missing packets
-                    thread_tcp_socket.send(missing_bytes)
+                    self.request_segment(selector)
+                return
+            
+            if any(kind != DONE for kind, _ in messages):
+                raise ProtocolError('Server sent an unexpected message during a round')
+        
+        # pick up any packets that arrived along with the signal
+        self.receive_packets()
         
-        segment_file.close()
+        # check for missing packets, counting as lost those the thread asked for in the round and did not report during
+        # it already
+        missing = self.segment.received.missing_ranges()
+        reported = self.segment.reported
+        unreported = [(max(start, reported), end) for start, end in missing if end > reported]
+        self.packet_loss += self.count_overlap(unreported, self.round_ranges)
+        
+        # send over the missing packets, blocking as the list may exceed the socket buffer
+        self.thread_tcp_socket.setblocking(True)
+        
+        if len(missing) == 0:
+            self.segment.workers.remove(self)
+            
+            # servers of the original protocol expect the thread to hang up once its only segment is complete
+            if self.header.version == 1:
+                self.finish(selector)
+            else:
+                self.thread_tcp_socket.sendall(pack_nack([]))
+                self.request_segment(selector)
+            return
+        
+        self.requested += sum(end - start for start, end in missing)
+        self.round_ranges = missing
+        self.repair_rounds += 1
+        self.segment.new_round()
+        
+        if self.header.version == 1:
+            self.thread_tcp_socket.sendall(self.header.pack_indices(self.missing_elements(self.segment.received)))
+        else:
+            self.thread_tcp_socket.sendall(pack_nack(missing))
+        
+        self.thread_tcp_socket.setblocking(False)
     
-    def connect_thread_sockets(self, thread_num):
+    def send_sack(self):
+        """Reports the blocks lost so far in the round, so that the server repairs them before the round ends"""
+        segment = self.segment
+        
+        # blocks of a segment sent by two streams arrive out of order
+        if self.header.version == 1 or segment is None or segment.workers != [self]:
+            return
+        
+        gaps = segment.unreported_gaps()
+        
+        if not gaps:
+            return
+        
+        lost = sum(end - start for start, end in gaps)
+        self.packet_loss += lost
+        self.requested += lost
+        self.thread_tcp_socket.setblocking(True)
+        self.thread_tcp_socket.sendall(pack_nack(gaps, selective = True))
+        self.thread_tcp_socket.setblocking(False)
+    
+    def finish(self, selector):
+        """Stops waiting on the thread's sockets and closes them"""
+        if self.segment is not None and self in self.segment.workers:
+            self.segment.workers.remove(self)
+        
+        if self.demultiplexer is None:
+            if self.registered:
+                selector.unregister(self.thread_udp_socket)
+            self.thread_udp_socket.close()
+        elif self.registered:
+            self.demultiplexer.detach(self, selector)
+        
+        if self.registered:
+            selector.unregister(self.thread_tcp_socket)
+        self.thread_tcp_socket.close()
+    
+    def connect_thread_sockets(self):
         """Establishes TCP and UDP connections with the server on a thread level"""
         thread_tcp_port = (self.server_name, self.new_server_tcp_port)
+        thread_num = self.thread_num
+        
+        # establishes UDP connection first, so the socket is ready by the time the server starts sending
+        if self.demultiplexer is not None:
+            thread_udp_socket = self.demultiplexer.udp_socket
+        else:
+            thread_udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            thread_udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            # each thread takes the port after the previous one, unless the OS picks them
+            thread_udp_port = self.client_udp_port + thread_num if self.client_udp_port else 0
+            thread_udp_socket.bind((self.client_name, thread_udp_port))
         
         # thread_num is (i + 1)
         thread_tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         thread_tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # a NACK and the next segment request go out back to back, Nagle's algorithm would hold the request back until
+        # the server acknowledges the NACK
+        thread_tcp_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         
         while True:
             try:
@@ -230,68 +1110,318 @@ class ThreadedClientSession(object):
             except socket.error as e:
                 print('{}\nwhen thread {} tries to connect to server'.format(e, thread_num))
         
-        # send over information about UDP socket
-        thread_tcp_socket.send(pickle.dumps((self.client_name, self.client_udp_port + thread_num)))
-        
-        # establishes UDP connection
-        thread_udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        thread_udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        thread_udp_socket.bind((self.client_name, self.client_udp_port + thread_num))
+        # send over information about UDP socket, and the codecs blocks may be compressed with
+        if self.header.version == 1:
+            thread_tcp_socket.send(pickle.dumps((self.client_name, thread_udp_socket.getsockname()[1])))
+        else:
+            thread_tcp_socket.sendall(pack_message(ATTACH, ATTACH_BODY.pack(thread_udp_socket.getsockname()[1],
+                                                                            supported_codecs()) +
+                                                   self.client_name.encode('utf-8')))
         
-        return thread_tcp_socket, thread_udp_socket
+        self.thread_tcp_socket, self.thread_udp_socket = thread_tcp_socket, thread_udp_socket
     
     @staticmethod
-    def show_summary(thread_num, start_time, end_time, packet_loss, blocks, transmission_count):
+    def show_summary(thread_num, start_time, end_time, packet_loss, requested, repair_rounds, corrupted_pieces):
         """Prints summary of the download status"""
         tqdm.write("***************************************")
         tqdm.write("Summary on Thread {}".format(thread_num))
-        tqdm.write("Total time taken: {}s".format(round(end_time - start_time, 5)))
-        tqdm.write("Percentage packet loss: {}%".format(round(packet_loss / (blocks * transmission_count), 10) * 100))
+        tqdm.write("Session time taken, all threads: {}s".format(round(end_time - start_time, 5)))
+        tqdm.write("Datagrams requested: {}, lost: {}".format(requested, packet_loss))
+        tqdm.write("Percentage packet loss: {}%".format(round(packet_loss / requested, 10) * 100))
+        tqdm.write("Retransmission rounds: {}".format(repair_rounds))
+        tqdm.write("Pieces failing their digest, all threads: {}".format(corrupted_pieces))
         tqdm.write("***************************************")
     
     @staticmethod
-    def save_packet(file, segment, segment_id_list):
-        """Saves the received packets onto the storage instantly to prevent memory hogging"""
-        segment_id = int.from_bytes(segment[:2], byteorder = 'big')
-        
-        # prevent repetitive writing
-        if segment_id not in segment_id_list:
-            # keep track of the received packets
-            segment_id_list.append(segment_id)
+    def preallocate(file, size):
+        """Sizes the output file once, reserving its blocks where the file system allows so that writes cannot fail"""
+        if os.fstat(file.fileno()).st_size == size:
+            return
+        
+        file.truncate(size)
+        
+        try:
+            os.posix_fallocate(file.fileno(), 0, size)
+        except (AttributeError, OSError):
+            # no fallocate on this platform or file system, the file stays sparse
+            pass
+    
+    @staticmethod
+    def count_overlap(ranges, others):
+        """
+        :param ranges: sorted list of (start, end) block ranges, end exclusive
+        :param others: sorted list of (start, end) block ranges, end exclusive
+        :return: number of blocks in both lists
+        """
+        count, i = 0, 0
+        
+        for start, end in ranges:
+            while i < len(others) and others[i][1] <= start:
+                i += 1
             
-            # offsets the previous packets
-            file.seek(segment_id * 1024)
-            file.write(segment[2:])
+            j = i
+            while j < len(others) and others[j][0] < end:
+                count += min(end, others[j][1]) - max(start, others[j][0])
+                j += 1
         
-        return segment_id_list
+        return count
     
     @staticmethod
-    def missing_elements(id_list, start, end):
+    def missing_elements(received):
         """
         Returns segment ID of the missing packets
         
-        :param id_list: list of segment ID received
-        :param start: ID of the first segment
-        :param end: ID of the last segment
+        :param received: BlockBitmap of the segments received
         :return: sorted list of missing packets
         """
-        return sorted(set(range(start, end + 1)).difference(id_list))
+        return [idx for start, end in received.missing_ranges() for idx in range(start, end)]
+
+
+class BlockBitmap(object):
+    """Tracks which blocks of a segment have been received, one bit per block"""
+    
+    # runs of bytes that are all-missing, or single bytes that are partly missing
+    _missing_bytes = re.compile(rb'\x00+|[^\x00\xff]')
+    
+    def __init__(self, size, bits = None):
+        """
+        :param size: number of blocks tracked
+        :param bits: bitmap of the blocks already received, None if there are none
+        """
+        self.size = size
+        self.bits = bytearray((size + 7) // 8)
+        
+        if bits:
+            length = min(len(bits), len(self.bits))
+            self.bits[:length] = bits[:length]
+            # blocks past the end of the segment cannot have been received
+            if size & 7:
+                self.bits[-1] &= (1 << (size & 7)) - 1
+        
+        self.count = bin(int.from_bytes(self.bits, 'little')).count('1')
+    
+    def __contains__(self, idx):
+        return bool(self.bits[idx >> 3] & (1 << (idx & 7)))
+    
+    def mark(self, idx):
+        """
+        Marks block idx as received
+        
+        :return: True if the block had not been received before
+        """
+        mask = 1 << (idx & 7)
+        
+        if self.bits[idx >> 3] & mask:
+            return False
+        
+        self.bits[idx >> 3] |= mask
+        self.count += 1
+        return True
+    
+    def clear(self, start, end):
+        """Marks blocks start to end, end exclusive, as not received"""
+        for idx in range(start, end):
+            mask = 1 << (idx & 7)
+            
+            if self.bits[idx >> 3] & mask:
+                self.bits[idx >> 3] &= ~mask
+                self.count -= 1
+    
+    def is_complete(self):
+        return self.count == self.size
+    
+    def missing_ranges(self):
+        """
+        Returns the blocks not received yet
+        
+        Fully received bytes are skipped by the regular expression engine, so the cost depends on the number of
+        gaps rather than on the size of the segment
+        
+        :return: sorted list of (start, end) ranges of missing block IDs, end exclusive
+        """
+        ranges = []
+        
+        for match in self._missing_bytes.finditer(self.bits):
+            if self.bits[match.start()] == 0:
+                gaps = [(match.start() * 8, match.end() * 8)]
+            else:
+                byte, base = self.bits[match.start()], match.start() * 8
+                gaps = [(base + bit, base + bit + 1) for bit in range(8) if not byte & (1 << bit)]
+            
+            for start, end in gaps:
+                end = min(end, self.size)
+                if start >= end:
+                    continue
+                
+                if ranges and ranges[-1][1] == start:
+                    ranges[-1] = (ranges[-1][0], end)
+                else:
+                    ranges.append((start, end))
+        
+        return ranges
+
+
+class DownloadJournal(object):
+    """
+    Progress of a download kept on disk next to the downloaded file, so that an interrupted download can be resumed
+    
+    The journal holds the digest the server gave for the file and the size of the blocks, followed by one bit per block
+    of the file, and is replaced atomically at every checkpoint. Checkpoints are written by a thread of their own, so
+    that flushing the downloaded file to a slow disk does not hold up receiving
+    """
+    
+    magic = b'MTDJ2'
+    # seconds between checkpoints
+    interval = 1.0
+    
+    def __init__(self, path, digest, block_size):
+        """
+        :param path: file the journal is kept in
+        :param digest: digest of the file given by the server at handshake
+        :param block_size: size of the blocks negotiated with the server
+        """
+        self.path = path
+        self.digest = digest
+        self.block_size = block_size
+        self.bits = bytearray()
+        self.last_checkpoint = time.time()
+        # thread writing the last checkpoint
+        self.writer = None
+    
+    def load(self):
+        """
+        Reads the progress left by an interrupted download
+        
+        :return: True if there is progress to resume, False if there is none or the file changed on the server since
+        """
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return False
+        
+        if not data.startswith(self.magic):
+            return False
+        
+        header_size = len(self.magic) + len(self.digest) + 4
+        
+        # refuse to mix blocks of two different versions of the file
+        if data[len(self.magic):len(self.magic) + len(self.digest)] != self.digest:
+            print('Client: File changed on the server since the download was interrupted, starting over')
+            return False
+        
+        # the bits stand for blocks of another size
+        if data[header_size - 4:header_size] != struct.pack('!I', self.block_size):
+            print('Client: Block size changed since the download was interrupted, starting over')
+            return False
+        
+        self.bits = bytearray(data[header_size:])
+        return True
+    
+    def reset(self):
+        """Forgets any progress, e.g. when the downloaded file is gone"""
+        self.bits = bytearray()
+        self.remove()
+    
+    def segment_bits(self, offset, blocks):
+        """
+        :param offset: offset of a segment in the file, starting on a piece boundary
+        :param blocks: number of blocks in the segment
+        :return: bitmap of the blocks of the segment saved so far
+        """
+        start = offset // self.block_size // 8
+        return self.bits[start:start + (blocks + 7) // 8]
+    
+    def count(self):
+        """Returns the number of blocks saved so far"""
+        return bin(int.from_bytes(self.bits, 'little')).count('1')
+    
+    def is_due(self):
+        return time.time() - self.last_checkpoint >= self.interval
+    
+    def checkpoint(self, output_file, segments, wait = False):
+        """
+        Records the blocks saved so far
+        
+        :param output_file: downloaded file the threads write into
+        :param segments: SegmentDownloads of the download
+        :param wait: True to wait until the checkpoint is on the disk, False to skip it while the last one is being
+        written
+        """
+        if self.writer is not None:
+            if not wait and self.writer.is_alive():
+                return
+            
+            self.writer.join()
+        
+        for segment in segments:
+            # segments start on a piece boundary, so each one covers whole bytes of the bitmap
+            start = segment.offset // self.block_size // 8
+            end = start + len(segment.received.bits)
+            
+            if len(self.bits) < end:
+                self.bits.extend(bytes(end - len(self.bits)))
+            
+            self.bits[start:end] = segment.received.bits
+        
+        # the blocks listed are all written to the file by now
+        self.writer = threading.Thread(target = self.write, args = (output_file, self.magic + self.digest +
+                                                                     struct.pack('!I', self.block_size) + self.bits))
+        self.writer.start()
+        self.last_checkpoint = time.time()
+        
+        if wait:
+            self.writer.join()
+    
+    def write(self, output_file, data):
+        """
+        :param output_file: downloaded file the threads write into
+        :param data: content of the journal
+        """
+        # data first, so that the journal never lists blocks that are not on the disk yet
+        os.fsync(output_file.fileno())
+        
+        temp_path = self.path + '.tmp'
+        
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        
+        os.replace(temp_path, self.path)
+    
+    def remove(self):
+        """Deletes the journal once the download is complete"""
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
 
 
 @click.command()
 @click.option('-c', '--client-name', help = 'Client Name', required = True)
-@click.option('--client-udp-port', help = 'Client UDP Port', default = 50000)
+@click.option('--client-udp-port', help = 'Client UDP Port, 0 for an Ephemeral One', default = 0)
 @click.option('-s', '--server-name', help = 'Server Name', required = True)
 @click.option('--server-tcp-port', help = 'Server TCP Port', default = 12001)
 @click.option('-f', '--filename', help = 'File to Download', required = True)
 @click.option('-t', '--num-threads', help = 'Number of Threads', default = 4)
-def start_client(client_name, client_udp_port, server_name, server_tcp_port, filename, num_threads):
-    client_session = MainClientSession(client_name, client_udp_port,
-                                       server_name, server_tcp_port,
-                                       filename, num_threads)
+@click.option('--batch-size', help = 'Kilobytes per System Call, 1 to Disable Batching', default = 32)
+@click.option('--block-size', help = 'Bytes of Data per Datagram, 0 to Fit the Path MTU', default = 0)
+@click.option('--multicast', help = 'Join a Multicast Session, Receiving the Blocks Sent to a Group', is_flag = True)
+def start_client(client_name, client_udp_port, server_name, server_tcp_port, filename, num_threads, batch_size,
+                 block_size, multicast):
+    try:
+        client_session = MainClientSession(client_name, client_udp_port,
+                                           server_name, server_tcp_port,
+                                           filename, num_threads, batch_size, block_size, multicast)
+    except RefusedError as e:
+        sys.exit('Client: Server cannot serve the file: {}'.format(e))
+    except ConnectionError as e:
+        sys.exit('Client: Could not start the download: {}'.format(e))
     
-    client_session.receive_data()
+    correct = client_session.receive_data()
     client_session.close_connection()
+    
+    if not correct:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,139 @@
+import zlib
+
+try:
+    import lz4.block
+except ImportError:
+    # optional, blocks are compressed with zlib instead
+    lz4 = None
+
+from MTD_protocol import CODEC_LZ4, CODEC_NONE, CODEC_ZLIB
+
+# codecs by the name they are chosen with on the command line
+CODEC_NAMES = {'none': CODEC_NONE, 'zlib': CODEC_ZLIB, 'lz4': CODEC_LZ4}
+
+
+def supported_codecs():
+    """
+    :return: bitmask of the codecs this end can compress and decompress blocks with, 1 << codec for each
+    """
+    codecs = 1 << CODEC_ZLIB
+    
+    if lz4 is not None:
+        codecs |= 1 << CODEC_LZ4
+    
+    return codecs
+
+
+def pick_codec(wanted, client_codecs):
+    """
+    :param wanted: codec the server is asked to compress blocks with
+    :param client_codecs: bitmask of the codecs the client decompresses
+    :return: the codec if both ends support it, falling back to zlib and then to none
+    """
+    if wanted == CODEC_NONE:
+        return CODEC_NONE
+    
+    for codec in (wanted, CODEC_ZLIB):
+        if (client_codecs & supported_codecs()) & (1 << codec):
+            return codec
+    
+    return CODEC_NONE
+
+
+def decompress_blocks(codec, payload, size):
+    """
+    :param codec: codec the payload is compressed with
+    :param payload: compressed blocks
+    :param size: most the blocks may decompress to
+    :return: the blocks, joined
+    """
+    if codec == CODEC_LZ4 and lz4 is not None:
+        try:
+            return lz4.block.decompress(payload, uncompressed_size = size)
+        except lz4.block.LZ4BlockError:
+            pass
+    elif codec == CODEC_ZLIB:
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        
+        # a byte more than the blocks may hold, so that the end of the stream is read after full blocks
+        try:
+            data = decompressor.decompress(payload, size + 1)
+        except zlib.error:
+            data = None
+        
+        if data is not None and decompressor.eof and len(data) <= size:
+            return data
+    
+    raise ValueError('Blocks cannot be decompressed with codec {}'.format(codec))
+
+
+class BlockCompressor(object):
+    """
+    Compresses the blocks of a stream, as many consecutive ones together as fit in a datagram, sending those that do
+    not compress well as they are
+    
+    Incompressible data, such as archives and media, is detected as it is sent: after each block that does not compress
+    well, twice as many blocks are sent as they are before trying again, so that little time is wasted on it
+    """
+    
+    # blocks must shrink to this fraction of their size to be sent compressed
+    ratio = 7 / 8
+    # blocks sent as they are at most between two tries
+    max_skip = 64
+    
+    def __init__(self, codec):
+        """
+        :param codec: codec negotiated with the client
+        """
+        self.codec = codec
+        self.skip = 0
+        self.backoff = 1
+        # compressed size of the last blocks over their size, to guess how many fit in the next datagram
+        self.estimate = 1.0
+    
+    def pack(self, data):
+        """
+        :param data: data to compress, bytes-like
+        :return: the data compressed with the codec
+        """
+        if self.codec == CODEC_LZ4:
+            return lz4.block.compress(data, store_size = False)
+        
+        # raw deflate, the pieces of the file are checked against their digests anyway
+        compressor = zlib.compressobj(1, zlib.DEFLATED, -zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+    
+    def compress(self, blocks, limit):
+        """
+        :param blocks: consecutive blocks of data, bytes-like, of which at least the first is sent
+        :param limit: largest payload that fits in a datagram
+        :return: (codec, payload, number of blocks in the payload), CODEC_NONE if the first block is sent as it is
+        """
+        if self.codec == CODEC_NONE:
+            return CODEC_NONE, blocks[0], 1
+        
+        if self.skip:
+            self.skip -= 1
+            return CODEC_NONE, blocks[0], 1
+        
+        count = max(1, min(len(blocks), int(limit / (len(blocks[0]) * self.estimate))))
+        
+        while True:
+            data = b''.join(blocks[:count]) if count > 1 else blocks[0]
+            payload = self.pack(data)
+            
+            if len(payload) <= limit or count == 1:
+                break
+            
+            # the blocks compress worse than the previous ones
+            count //= 2
+        
+        self.estimate = max(len(payload) / len(data), 1 / 64)
+        
+        if len(payload) <= len(data) * self.ratio:
+            self.backoff = 1
+            return self.codec, payload, count
+        
+        self.skip = self.backoff
+        self.backoff = min(2 * self.backoff, self.max_skip)
+        return CODEC_NONE, blocks[0], 1
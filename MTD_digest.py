@@ -0,0 +1,237 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from MTD_protocol import PIECE_SIZE
+
+
+def file_identity(filename):
+    """
+    Identifies the current content of a file without reading it
+    
+    :param filename: path of the file
+    :return: (absolute path, size, modification time in ns, inode) of the file
+    """
+    stat = os.stat(filename)
+    return os.path.abspath(filename), stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+
+def merkle_root(leaves):
+    """
+    Hashes a list of piece digests pairwise up to a single root, promoting the odd one out of each level as is
+    
+    :param leaves: MD5 digests of the pieces, in order
+    :return: root digest of the hash tree
+    """
+    level = list(leaves)
+    
+    if not level:
+        return hashlib.md5().digest()
+    
+    while len(level) > 1:
+        level = [hashlib.md5(b''.join(level[i:i + 2])).digest() if i + 1 < len(level) else level[i]
+                 for i in range(0, len(level), 2)]
+    
+    return level[0]
+
+
+def md5(filename):
+    """
+    To calculate a MD5 hash for client to check integrity, along with the hash of every piece of the file
+    
+    :param filename: path of the file
+    :return: FileDigest of the file
+    """
+    
+    hash_md5 = hashlib.md5()
+    leaves = []
+    size = 0
+    
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(PIECE_SIZE), b''):
+            hash_md5.update(chunk)
+            leaves.append(hashlib.md5(chunk).digest())
+            size += len(chunk)
+    
+    return FileDigest(hash_md5.digest(), leaves, size)
+
+
+class FileDigest(object):
+    """Whole-file MD5 of a file and the hash tree over its pieces"""
+    
+    def __init__(self, md5_digest, leaves, size):
+        """
+        :param md5_digest: MD5 digest of the whole file
+        :param leaves: MD5 digests of the pieces of PIECE_SIZE bytes, in order
+        :param size: size of the file hashed
+        """
+        self.md5 = md5_digest
+        self.leaves = leaves
+        self.size = size
+        self.root = merkle_root(leaves)
+    
+    def segment_leaves(self, offset, length):
+        """
+        :param offset: offset of a segment starting on a piece boundary
+        :param length: length of the segment
+        :return: digests of the pieces of the segment
+        """
+        return self.leaves[offset // PIECE_SIZE:(offset + length + PIECE_SIZE - 1) // PIECE_SIZE]
+
+
+class DigestCache(object):
+    """
+    Digests of served files, kept in memory with LRU eviction and persisted to disk
+    
+    Entries are keyed by the file identity, so a file that is modified, truncated or replaced is hashed again while
+    repeat requests for an unchanged file skip hashing entirely. On disk, the digests of the pieces of each file are
+    kept in a binary file of their own, named after the MD5 of the file and written once, next to an index of the
+    identities and MD5s rewritten on every change
+    """
+    
+    def __init__(self, path, capacity):
+        """
+        :param path: directory the cache is persisted to, empty to keep it in memory only
+        :param capacity: maximum number of digests kept
+        """
+        self.path = path
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        # events set once the file being hashed for a request is cached, so concurrent requests wait for it rather
+        # than hash it too
+        self.hashing = {}
+        # shared by the master threads of the threaded engine
+        self.lock = threading.Lock()
+        # serializes the saves, made outside the lock so that requests for other files are not held up meanwhile: the
+        # last index is written last, and the digests of the pieces it lists are never deleted
+        self.save_lock = threading.Lock()
+        self.load()
+    
+    def index_path(self):
+        return os.path.join(self.path, 'index.json')
+    
+    def leaves_path(self, md5_digest):
+        return os.path.join(self.path, md5_digest.hex() + '.leaves')
+    
+    def load(self):
+        """Reads the digests persisted by a previous run, starting empty if there are none or they are unreadable"""
+        if not self.path:
+            return
+        
+        try:
+            with open(self.index_path(), 'r') as f:
+                index = json.load(f)
+            
+            for identity, digest in index:
+                digest = bytes.fromhex(digest)
+                
+                with open(self.leaves_path(digest), 'rb') as f:
+                    leaves = f.read()
+                
+                self.entries[tuple(identity)] = FileDigest(digest,
+                                                           [leaves[i:i + 16] for i in range(0, len(leaves), 16)],
+                                                           identity[1])
+        except (OSError, ValueError, TypeError):
+            self.entries.clear()
+            return
+        
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last = False)
+    
+    def save_leaves(self, digest):
+        """Writes the digests of the pieces of a newly hashed file, unless a file of the same content has them"""
+        if not self.path:
+            return
+        
+        path = self.leaves_path(digest.md5)
+        temp_path = path + '.tmp'
+        
+        try:
+            if not os.path.exists(path):
+                os.makedirs(self.path, exist_ok = True)
+                
+                with open(temp_path, 'wb') as f:
+                    f.write(b''.join(digest.leaves))
+                os.replace(temp_path, path)
+        except OSError as e:
+            print('Server: Could not save digest cache: {}'.format(e))
+    
+    def save(self, index):
+        """
+        Persists the index of the digests, replacing the previous one atomically, and deletes the digests of the pieces
+        no entry uses any more
+        
+        :param index: [identity, MD5 in hex] of every entry, least recently used first
+        """
+        if not self.path:
+            return
+        
+        temp_path = self.index_path() + '.tmp'
+        
+        try:
+            with open(temp_path, 'w') as f:
+                json.dump(index, f)
+            os.replace(temp_path, self.index_path())
+            
+            kept = {digest + '.leaves' for _, digest in index}
+            
+            for name in os.listdir(self.path):
+                if name.endswith('.leaves') and name not in kept:
+                    os.remove(os.path.join(self.path, name))
+        except OSError as e:
+            print('Server: Could not save digest cache: {}'.format(e))
+    
+    def store(self, identity, digest):
+        """Caches the digest of a file, evicting the least recently used ones beyond capacity, and persists it"""
+        with self.save_lock:
+            # written before the index lists them
+            self.save_leaves(digest)
+            
+            with self.lock:
+                self.entries[identity] = digest
+                
+                while len(self.entries) > self.capacity:
+                    self.entries.popitem(last = False)
+                
+                index = [[key, value.md5.hex()] for key, value in self.entries.items()]
+            
+            self.save(index)
+    
+    def digest(self, filename):
+        """
+        :param filename: path of the file
+        :return: FileDigest of the file, hashed only if the file changed since it was last hashed
+        """
+        identity = file_identity(filename)
+        
+        while True:
+            with self.lock:
+                if identity in self.entries:
+                    self.entries.move_to_end(identity)
+                    return self.entries[identity]
+                
+                hashing = self.hashing.get(identity)
+                
+                if hashing is None:
+                    hashing = self.hashing[identity] = threading.Event()
+                    break
+            
+            hashing.wait()
+        
+        try:
+            digest = md5(filename)
+            
+            # the file may have changed while it was being hashed, the digest is then only good for this request
+            if file_identity(filename) != identity:
+                return digest
+            
+            self.store(identity, digest)
+        finally:
+            with self.lock:
+                del self.hashing[identity]
+            
+            hashing.set()
+        
+        return digest
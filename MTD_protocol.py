@@ -0,0 +1,343 @@
+import io
+import pickle
+import re
+import struct
+
+# data header version this code speaks, offered by the client at handshake
+PROTOCOL_VERSION = 2
+
+# version 1: the original protocol, kept for the clients and servers of the first release: pickled handshake, text
+#            control messages, one segment per client thread and a 16-bit block index limiting it to 65536 blocks
+# version 2: 8-bit version, 8-bit flags, 16-bit stream ID, 32-bit block index, with every control message framed as
+#            below; segments are handed out to the client threads on demand and verified piece by piece against a
+#            hash tree of the file
+_V1_HEADER = struct.Struct('!H')
+_V2_HEADER = struct.Struct('!BBHI')
+
+# NACKs start with their encoding and the size of what follows
+NACK_HEADER = struct.Struct('!BI')
+# (start, end) block ranges, or the first missing block followed by one bit per block from there, set if missing
+NACK_RANGES = 0
+NACK_BITMAP = 1
+# set in the encoding of NACKs sent during a round rather than in answer to its DONE signal
+NACK_SELECTIVE = 0x80
+
+# every control message starts with its type and the size of its body, like the NACKs, whose encodings are kept as
+# types
+MESSAGE_HEADER = NACK_HEADER
+HELLO = 0x10  # client: highest version understood, number of threads, block size wished for, then the filename
+WELCOME = 0x11  # server: port of the session, version, block size
+DIGEST = 0x12  # server: root of the piece hash tree of the file
+ATTACH = 0x13  # client thread: UDP port, codecs it decompresses, then IP address receiving data
+REQUEST = 0x14  # client thread: segment number
+SEGMENT = 0x15  # server: blocks, offset, file size, number of segments, then the digests of the segment's pieces
+DONE = 0x16  # server: end of a round of transmission
+JOIN = 0x17  # client: same as HELLO, for a multicast session
+GROUP = 0x18  # server: same as WELCOME, then the address and port of the group, the file size and the segment size
+ERROR = 0x19  # server: why the file cannot be served, in place of the WELCOME, GROUP or DIGEST
+HELLO_BODY = struct.Struct('!HHI')
+WELCOME_BODY = struct.Struct('!HHI')
+GROUP_BODY = struct.Struct('!HHI4sHQI')
+ATTACH_BODY = struct.Struct('!HB')
+REQUEST_BODY = struct.Struct('!I')
+SEGMENT_BODY = struct.Struct('!IQQI')
+# largest body accepted, so that a bogus size cannot make either end buffer without bounds
+MAX_MESSAGE_SIZE = 1 << 24
+# first byte of the pickles sent at handshake by the original protocol
+PICKLE_PROTOCOL = 0x80
+
+# bytes of file data per datagram, negotiated at handshake within the limits below; powers of two, so that pieces and
+# segments always hold whole blocks. The original protocol always uses BLOCK_SIZE
+BLOCK_SIZE = 1024
+MIN_BLOCK_SIZE = 512
+MAX_BLOCK_SIZE = 32768
+
+# set in the flags of a parity block, whose index is that of the first block it covers and whose
+# other flag bits give the number of blocks covered minus one; the payload is the XOR of those blocks, each padded
+# with zeros to the block size, so that any one of them can be rebuilt from the others
+FLAG_PARITY = 0x80
+MAX_PARITY_BLOCKS = FLAG_PARITY
+
+# the low bits of the flags of a data block give the codec its payload is compressed with, and the
+# next bits the number of consecutive blocks compressed together into it minus one, so that datagrams of compressible
+# data stay full; the codecs a client decompresses are sent as a bitmask of 1 << codec
+CODEC_MASK = 0x0F
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_LZ4 = 2
+RUN_SHIFT = 4
+MAX_RUN_BLOCKS = 8
+
+# blocks are hashed in pieces of this many bytes, and segments start on a piece boundary
+PIECE_SIZE = 65536
+
+# files are split into segments of at least this many bytes, the original protocol cuts them in one per client thread
+SEGMENT_SIZE = 16 * PIECE_SIZE
+
+
+def negotiate_version(client_version):
+    """
+    Picks the data header version used for a session
+    
+    :param client_version: highest version offered by the client, None for clients of the original protocol
+    :return: version both ends understand
+    """
+    if client_version is None:
+        return 1
+    
+    return min(int(client_version), PROTOCOL_VERSION)
+
+
+def negotiate_block_size(client_block_size):
+    """
+    Picks the block size used for a session
+    
+    :param client_block_size: block size asked for by the client
+    :return: largest power of two within the supported limits not above the one asked for
+    """
+    block_size = MIN_BLOCK_SIZE
+    
+    while block_size * 2 <= min(int(client_block_size), MAX_BLOCK_SIZE):
+        block_size *= 2
+    
+    return block_size
+
+
+def _pack_bounds(ranges):
+    return struct.pack('!{}I'.format(2 * len(ranges)), *[bound for block_range in ranges for bound in block_range])
+
+
+def unpack_ranges(data):
+    """
+    :param data: (start, end) block ranges packed as 32-bit bounds
+    :return: list of (start, end) block ranges, end exclusive
+    """
+    bounds = struct.unpack('!{}I'.format(len(data) // 4), data)
+    return list(zip(bounds[::2], bounds[1::2]))
+
+
+def pack_nack(ranges, selective = False):
+    """
+    Encodes missing blocks in as few bytes as possible, so that a NACK stays small whatever the loss pattern
+    
+    Ranges take 8 bytes per gap and suit bursts of loss, the bitmap takes a bit per block between the first and the
+    last missing one and suits scattered loss
+    
+    :param ranges: sorted list of (start, end) ranges of missing blocks, end exclusive, empty once all are received
+    :param selective: True if the NACK is sent during a round
+    :return: the NACK prefixed with its encoding and size
+    """
+    flags = NACK_SELECTIVE if selective else 0
+    
+    if ranges:
+        base, span = ranges[0][0], ranges[-1][1] - ranges[0][0]
+        
+        if 4 + (span + 7) // 8 < 8 * len(ranges):
+            bits = 0
+            for start, end in ranges:
+                bits |= ((1 << (end - start)) - 1) << (start - base)
+            
+            body = struct.pack('!I', base) + bits.to_bytes((span + 7) // 8, 'little')
+            return NACK_HEADER.pack(NACK_BITMAP | flags, len(body)) + body
+    
+    body = _pack_bounds(ranges)
+    return NACK_HEADER.pack(NACK_RANGES | flags, len(body)) + body
+
+
+def unpack_nack(encoding, body):
+    """
+    :param encoding: encoding given in the NACK header
+    :param body: the NACK without its header
+    :return: sorted list of (start, end) ranges of missing blocks, end exclusive
+    """
+    if encoding & ~NACK_SELECTIVE != NACK_BITMAP:
+        return unpack_ranges(body)
+    
+    base = struct.unpack_from('!I', body)[0]
+    # lowest block first
+    bits = bin(int.from_bytes(body[4:], 'little'))[:1:-1]
+    return [(base + match.start(), base + match.end()) for match in re.finditer('1+', bits)]
+
+
+def xor_blocks(blocks, block_size):
+    """
+    :param blocks: blocks of data, bytes-like, none longer than block_size
+    :param block_size: size of the result
+    :return: XOR of the blocks, padded with zeros to block_size
+    """
+    value = 0
+    
+    # little-endian, so that short blocks are padded at the end
+    for block in blocks:
+        value ^= int.from_bytes(block, 'little')
+    
+    return value.to_bytes(block_size, 'little')
+
+
+class ProtocolError(ConnectionError):
+    """Raised when the other end sends a control message that is not the one expected"""
+
+
+class RefusedError(ConnectionError):
+    """Raised when the other end sends an ERROR message instead of the one expected"""
+
+
+def pack_message(kind, body = b''):
+    """
+    :param kind: type of the message
+    :param body: body of the message
+    :return: the body prefixed with its type and size
+    """
+    return MESSAGE_HEADER.pack(kind, len(body)) + body
+
+
+def message_size(header, expected):
+    """
+    :param header: MESSAGE_HEADER of a received message
+    :param expected: type the message must be of
+    :return: size of the body that follows
+    """
+    kind, size = MESSAGE_HEADER.unpack(header)
+    
+    if kind != expected:
+        raise ProtocolError('Expected message 0x{:02x}, got 0x{:02x}'.format(expected, kind))
+    
+    if size > MAX_MESSAGE_SIZE:
+        raise ProtocolError('Message of {} bytes is too large'.format(size))
+    
+    return size
+
+
+def recv_exactly(sock, size):
+    """Receives exactly size bytes from a blocking socket"""
+    data = b''
+    
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        
+        if not chunk:
+            raise ConnectionError('Connection closed by the other end')
+        
+        data += chunk
+    
+    return data
+
+
+def recv_message(sock, expected):
+    """
+    Receives a control message from a blocking socket, without reading past it
+    
+    :param sock: TCP socket
+    :param expected: type the message must be of
+    :return: body of the message
+    """
+    header = recv_exactly(sock, MESSAGE_HEADER.size)
+    
+    if header[0] == ERROR and expected != ERROR:
+        raise RefusedError(recv_exactly(sock, message_size(header, ERROR)).decode('utf-8', 'replace'))
+    
+    return recv_exactly(sock, message_size(header, expected))
+
+
+def split_messages(data):
+    """
+    :param data: bytes received so far
+    :return: (list of (type, body) of the complete messages at the start of data, bytes of the incomplete one)
+    """
+    messages = []
+    
+    while len(data) >= MESSAGE_HEADER.size:
+        kind, size = MESSAGE_HEADER.unpack_from(data)
+        
+        if len(data) < MESSAGE_HEADER.size + size:
+            break
+        
+        messages.append((kind, data[MESSAGE_HEADER.size:MESSAGE_HEADER.size + size]))
+        data = data[MESSAGE_HEADER.size + size:]
+    
+    return messages, data
+
+
+class _PlainUnpickler(pickle.Unpickler):
+    """Unpickler refusing to look up any class or function, so that a pickle can only hold plain values"""
+    
+    def find_class(self, module, name):
+        raise pickle.UnpicklingError('{}.{} is not allowed in a handshake'.format(module, name))
+
+
+def load_legacy(data):
+    """
+    Decodes a control message pickled by an end speaking the original protocol
+    
+    :param data: bytes or binary file holding the pickle
+    :return: the tuple, string or number pickled
+    """
+    return _PlainUnpickler(io.BytesIO(data) if isinstance(data, bytes) else data).load()
+
+
+class DataHeader(object):
+    """Header prepended to every block sent over UDP"""
+    
+    def __init__(self, version, block_size = BLOCK_SIZE):
+        """
+        :param version: negotiated header version
+        :param block_size: negotiated bytes of file data per datagram
+        """
+        self.version = version
+        self.block_size = block_size
+        # blocks hashed together
+        self.piece_blocks = PIECE_SIZE // block_size
+        self.header = _V1_HEADER if version == 1 else _V2_HEADER
+        self.size = self.header.size
+        # block indices that fit in the header
+        self.max_blocks = 1 << (16 if version == 1 else 32)
+        # format code used for block indices in NACKs
+        self.index_code = 'H' if version == 1 else 'I'
+        self.index_size = struct.calcsize(self.index_code)
+    
+    def pack(self, idx, stream = 0, flags = 0):
+        """
+        :param idx: block index within the segment
+        :param stream: stream the block belongs to
+        :param flags: flags describing the payload
+        :return: header bytes
+        """
+        if self.version == 1:
+            return self.header.pack(idx)
+        
+        return self.header.pack(self.version, flags, stream, idx)
+    
+    def unpack(self, datagram):
+        """
+        :param datagram: received datagram
+        :return: (block index, stream, flags) of the datagram, or None if it is not of this header version or too short
+        to carry a header
+        """
+        if len(datagram) < self.size:
+            return None
+        
+        if self.version == 1:
+            return self.header.unpack_from(datagram)[0], 0, 0
+        
+        version, flags, stream, idx = self.header.unpack_from(datagram)
+        
+        if version != self.version:
+            return None
+        
+        return idx, stream, flags
+    
+    def datagrams_for(self, size):
+        """
+        :param size: number of bytes of file data
+        :return: number of datagrams carrying at most that many bytes, at least one
+        """
+        return max(1, size // self.block_size)
+    
+    def pack_indices(self, indices):
+        """Encodes block indices for a NACK of the original protocol"""
+        return struct.pack('!{}{}'.format(len(indices), self.index_code), *indices)
+    
+    def unpack_indices(self, data):
+        """Decodes the block indices of a NACK"""
+        count = len(data) // self.index_size
+        return list(struct.unpack_from('!{}{}'.format(count, self.index_code), data))
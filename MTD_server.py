@@ -1,246 +1,1344 @@
-import hashlib
+import asyncio
 import os
 import pickle
-import random
+import select
 import socket
 import threading
 import time
+from collections import OrderedDict, deque
 from math import ceil
-from shutil import rmtree
 
 import click
-from fsplit.filesplit import FileSplit
+
+from MTD_batchio import BatchSender
+from MTD_cache import BlockCache
+from MTD_compress import CODEC_NAMES, BlockCompressor, pick_codec, supported_codecs
+from MTD_digest import DigestCache, file_identity
+from MTD_protocol import (ATTACH, ATTACH_BODY, BLOCK_SIZE, CODEC_NONE, DIGEST, DONE, ERROR, FLAG_PARITY, GROUP,
+                          GROUP_BODY, HELLO, HELLO_BODY, JOIN, MAX_PARITY_BLOCKS, MAX_RUN_BLOCKS, MESSAGE_HEADER,
+                          NACK_HEADER, NACK_SELECTIVE, PICKLE_PROTOCOL, REQUEST, REQUEST_BODY, RUN_SHIFT, SEGMENT,
+                          SEGMENT_BODY, SEGMENT_SIZE, WELCOME, WELCOME_BODY, DataHeader, ProtocolError, load_legacy,
+                          message_size, negotiate_block_size, negotiate_version, pack_message, recv_exactly,
+                          recv_message, unpack_nack, xor_blocks)
+
+
+class ServerSettings(object):
+    """How the server sends the files it serves, shared by every session"""
+    
+    def __init__(self, trans_rate, rate_control = 'aimd', burst_size = 32, batch_size = 32, digest_cache = None,
+                 block_cache = None, multicast = None, parity_blocks = 0, compression = CODEC_NONE):
+        """
+        :param trans_rate: user-specified transfer rate, the highest one under AIMD rate control
+        :param rate_control: 'aimd' to adapt the rate of each stream to the loss reported by the client, 'fixed' to
+        send at trans_rate
+        :param burst_size: kilobytes sent back to back between pacing sleeps
+        :param batch_size: kilobytes handed to the kernel per system call
+        :param digest_cache: DigestCache of the files served, None for an in-memory one
+        :param block_cache: BlockCache the blocks are read through, None to read every block from disk
+        :param multicast: MulticastGroups serving the clients joining a multicast session, None to refuse them
+        :param parity_blocks: number of blocks covered by each parity block, 0 to send none
+        :param compression: codec the blocks are compressed with for clients supporting it, CODEC_NONE to send them as
+        they are
+        """
+        self.trans_rate = trans_rate
+        self.rate_control = rate_control
+        self.burst_size = burst_size
+        self.batch_size = batch_size
+        self.digest_cache = digest_cache if digest_cache is not None else DigestCache('', 256)
+        self.block_cache = block_cache if block_cache is not None else BlockCache(0)
+        self.multicast = multicast
+        self.parity_blocks = parity_blocks
+        self.compression = compression
+    
+    def burst_bytes(self, header):
+        """
+        Bursts and batches hold as many bytes whatever the block size, so that large blocks do not flood the receivers
+        
+        :param header: DataHeader of the datagrams sent
+        :return: number of bytes sent back to back between pacing sleeps
+        """
+        return header.datagrams_for(self.burst_size * BLOCK_SIZE) * (header.size + header.block_size)
+    
+    def batch_datagrams(self, header):
+        """
+        :param header: DataHeader of the datagrams sent
+        :return: number of datagrams handed to the kernel per system call
+        """
+        return header.datagrams_for(self.batch_size * BLOCK_SIZE)
 
 
 class MainServerSession(object):
     """Main Server for listening to any incoming connection"""
     
-    def __init__(self, server_name, server_tcp_port, trans_rate):
+    def __init__(self, server_name, server_tcp_port, settings, engine = 'threaded'):
         """
         :param server_name: IP address of server
         :param server_tcp_port: port number of tcp socket of MmainServerSession
-        :param trans_rate: user-specified transfer rate
+        :param settings: ServerSettings shared by all connections
+        :param engine: 'threaded' for a thread per connection and stream, 'asyncio' for a single event loop
         """
         
         self.server_tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_name = server_name
         self.server_tcp_port = server_tcp_port
-        self.trans_rate = trans_rate
+        self.settings = settings
+        self.engine = engine
         self.num_threads = 0
         self.filename = ''
     
     def initialize_connection(self):
         """Start server and wait for tcp connection"""
         
+        if self.engine == 'asyncio':
+            asyncio.run(self.serve_asyncio())
+            return
+        
         # wait for TCP connection from client
         self.server_tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)  # allow reuse of port numbers
         self.server_tcp_socket.bind((self.server_name, self.server_tcp_port))
-        self.server_tcp_socket.listen(5)
+        # concurrent clients connect in bursts, as many as asyncio lets wait by default
+        self.server_tcp_socket.listen(100)
         print('Server: Listening for connections')
         
         # keep listening for incoming connection and spawn a new master thread for handling the incoming connection
         while True:
             server_tcp_connection, addr = self.server_tcp_socket.accept()
-            master = MasterThreadedServerSession(self.server_name, self.trans_rate, server_tcp_connection)
+            master = MasterThreadedServerSession(self.server_name, self.settings, server_tcp_connection)
             master_thread = threading.Thread(target = master.create_master_thread)
-            master_thread.setDaemon(True)
+            master_thread.daemon = True
             master_thread.start()
             print("Server: New connection accepted")
     
+    async def serve_asyncio(self):
+        """Start server and serve every connection and stream from one event loop"""
+        
+        server = await asyncio.start_server(self.accept_asyncio, self.server_name, self.server_tcp_port,
+                                            reuse_address = True)
+        print('Server: Listening for connections')
+        
+        async with server:
+            await server.serve_forever()
+    
+    async def accept_asyncio(self, reader, writer):
+        """Handle an incoming connection on the event loop"""
+        print("Server: New connection accepted")
+        master = MasterAsyncServerSession(self.server_name, self.settings, reader, writer)
+        await master.create_master_task()
+    
     def close_connection(self):
         """Close any open socket"""
         self.server_tcp_socket.close()
 
 
+class BaseMasterServerSession(object):
+    """File request handling shared by the threaded and the asyncio master sessions"""
+    
+    def __init__(self, server_name, settings):
+        """
+        :param server_name: IP address of server_name
+        :param settings: ServerSettings of the server
+        """
+        
+        self.server_name = server_name
+        self.settings = settings
+        self.num_threads = 0
+        self.filename = ''
+        self.segments = {}
+        self.file_size = 0
+        self.segment_size = 0
+        self.header = None
+        # MulticastChannel of the file for multicast sessions
+        self.channel = None
+        self.digest = None
+    
+    def parse_hello(self, body):
+        """Reads the header version, the number of threads, the block size and the filename from the client's HELLO"""
+        
+        client_version, self.num_threads, block_size = HELLO_BODY.unpack_from(body)
+        self.filename = body[HELLO_BODY.size:].decode('utf-8')
+        self.header = DataHeader(negotiate_version(client_version), negotiate_block_size(block_size))
+    
+    def parse_request(self, header, body):
+        """
+        Reads the client's HELLO, or its JOIN, joining the multicast channel of the file
+        
+        :param header: MESSAGE_HEADER of the request
+        :param body: body of the request
+        """
+        self.parse_hello(body)
+        
+        if header[0] == JOIN:
+            self.channel = self.settings.multicast.join(self.filename, self.header)
+    
+    def request_size(self, header):
+        """
+        :param header: MESSAGE_HEADER of the client's request
+        :return: size of the request, which is a HELLO or, if multicast is enabled, a JOIN
+        """
+        return message_size(header, JOIN if header[0] == JOIN and self.settings.multicast is not None else HELLO)
+    
+    def leave_channel(self):
+        """Lets the multicast channel of the file stop once no other session uses it"""
+        if self.channel is not None:
+            self.settings.multicast.leave(self.channel)
+    
+    def parse_client_info(self, client_info):
+        """Reads the number of threads and the filename pickled by a client of the original protocol"""
+        
+        self.num_threads, self.filename = load_legacy(client_info)
+        self.num_threads = int(self.num_threads)
+        self.header = DataHeader(negotiate_version(None), BLOCK_SIZE)
+    
+    def port_message(self, port):
+        """Tells connecting client the new tcp socket to connect to, the header version and the block size to expect"""
+        
+        if self.channel is not None:
+            return pack_message(GROUP, GROUP_BODY.pack(port, self.header.version, self.header.block_size,
+                                                       socket.inet_aton(self.channel.address[0]),
+                                                       self.channel.address[1], self.file_size, self.segment_size))
+        
+        if self.header.version == 1:
+            return pickle.dumps(port)
+        
+        return pack_message(WELCOME, WELCOME_BODY.pack(port, self.header.version, self.header.block_size))
+    
+    def segment_file(self):
+        """
+        Segment file based on number of threads
+        
+        Segments are virtual: each one is an (offset, length) byte range of the original file, keyed by the segment
+        name the client threads ask for, so nothing is copied before the first byte is sent
+        
+        Client threads take segments on demand, so there are many small ones and threads done early help the slower
+        ones instead of waiting for them; segment numbers are stream IDs, so there are at most 65535 of them. Their size
+        is a multiple of SEGMENT_SIZE, so that they start on a piece boundary and cover whole bytes of the client's
+        bitmap of blocks whatever the size of the blocks. Clients of the original protocol get one segment per thread
+        """
+        
+        # opened rather than looked up, so that a file the server cannot read is refused before the client is welcomed
+        with open(self.filename, 'rb') as f:
+            self.file_size = file_size = os.fstat(f.fileno()).st_size
+        
+        if self.header.version == 1:
+            chunk_size = ceil(file_size / self.num_threads)
+            count = self.num_threads
+        else:
+            chunk_size = max(1, ceil(file_size / 0xFFFF / SEGMENT_SIZE)) * SEGMENT_SIZE
+            count = ceil(file_size / chunk_size)
+        
+        # multicast receivers are told the layout up front, to keep the blocks sent for the other receivers
+        self.segment_size = chunk_size
+        
+        name, ext = os.path.splitext(self.filename)
+        self.segments = {}
+        
+        for i in range(count):
+            offset = min(i * chunk_size, file_size)
+            length = min(chunk_size, file_size - offset)
+            self.segments["{0}_{1}{2}".format(name, i + 1, ext)] = (i + 1, offset, length)
+        
+        return
+    
+    def handshake_digest(self):
+        """
+        To get the hash for client to check integrity, only hashing files not seen unchanged before
+        
+        :return: DIGEST message with the root of the piece hash tree, the MD5 of the whole file for clients of the
+        original protocol
+        """
+        
+        self.digest = self.settings.digest_cache.digest(self.filename)
+        
+        if self.header.version == 1:
+            return self.digest.md5
+        
+        return pack_message(DIGEST, self.digest.root)
+    
+    def error_message(self, error):
+        """
+        :param error: OSError raised opening or reading the requested file
+        :return: ERROR message telling the client why the file cannot be served, nothing for clients of the original
+        protocol, which only see the connection close; clients whose request could not be read are taken for framed ones
+        """
+        print('Server: Cannot serve {0}: {1}'.format(self.filename or 'the request', error))
+        
+        if self.header is not None and self.header.version == 1:
+            return b''
+        
+        return pack_message(ERROR, str(error).encode('utf-8'))
+
+
 # Master Thread for handling an incoming connection
-class MasterThreadedServerSession(object):
+class MasterThreadedServerSession(BaseMasterServerSession):
     """Create new thread for each new file request"""
     
-    def __init__(self, server_name, trans_rate, server_tcp_connection):
+    def __init__(self, server_name, settings, server_tcp_connection):
         """
         :param server_name: IP address of server_name
-        :param trans_rate: user-specified transfer rate
+        :param settings: ServerSettings of the server
         :param server_tcp_connection: spawned tcp socket with accepted connection
         """
         
+        super(MasterThreadedServerSession, self).__init__(server_name, settings)
         self.new_server_tcp_connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_name = server_name
-        self.trans_rate = trans_rate
-        self.num_threads = 0
-        self.filename = ''
         self.server_tcp_connection = server_tcp_connection
+        self.server_udp_socket = None
     
     def create_master_thread(self):
         """Start the master thread for handling incoming connection"""
         
-        client_info = self.server_tcp_connection.recv(1024)
-        self.num_threads, self.filename = pickle.loads(client_info)
-        self.num_threads = int(self.num_threads)
-        
-        # print('Server: File {0} is requested by Client {1} with {2} threads.'
-        #       .format(self.filename, self.server_name, self.num_threads))
+        try:
+            header = recv_exactly(self.server_tcp_connection, MESSAGE_HEADER.size)
+            
+            # clients of the original protocol pickle their request, in a single send
+            if header[0] == PICKLE_PROTOCOL:
+                self.parse_client_info(header + self.server_tcp_connection.recv(1024))
+            else:
+                self.parse_request(header, recv_exactly(self.server_tcp_connection, self.request_size(header)))
+            
+            # print('Server: File {0} is requested by Client {1} with {2} threads.'
+            #       .format(self.filename, self.server_name, self.num_threads))
+            
+            # master segments file based on number of threads
+            self.segment_file()
+        except ProtocolError as e:
+            self.refuse(e)
+            return
+        except ConnectionError:
+            # the client hung up before its request was complete
+            self.server_tcp_connection.close()
+            self.new_server_tcp_connection.close()
+            return
+        except OSError as e:
+            self.refuse(e)
+            return
         
-        # master segments file based on number of threads
-        self.segment_file()
-        # create new socket for listening to incoming tcp connection from client threads 
-        rand_server_tcp_port = random.randint(49152, 65535)  # 49152-65535
-        self.new_server_tcp_connection.bind((self.server_name, rand_server_tcp_port))
+        # create new socket for listening to incoming tcp connection from client threads, on a port of its own picked
+        # by the OS so that concurrent sessions never collide
+        self.new_server_tcp_connection.bind((self.server_name, 0))
+        # now wait for incoming tcp connection from client threads, which connect all at once as soon as they know the
+        # port
+        self.new_server_tcp_connection.listen(self.num_threads)
         # tell connecting client the new tcp socket to connect to
-        self.server_tcp_connection.send(pickle.dumps(rand_server_tcp_port))
-        self.server_tcp_connection.send(self.md5(self.filename))
-        # now wait for incoming tcp connection from client threads
-        self.new_server_tcp_connection.listen(5)  # backlog refers to the # of pending connections the queue will hold
+        self.server_tcp_connection.send(self.port_message(self.new_server_tcp_connection.getsockname()[1]))
+        
+        try:
+            digest = self.handshake_digest()
+        except OSError as e:
+            self.refuse(e)
+            return
+        
+        self.server_tcp_connection.send(digest)
+        
+        # one udp socket sends the data of every thread, the stream ID in the header tells the client which is which
+        self.server_udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.server_udp_socket.bind((self.server_name, 0))
+        
+        streams = []
         
         # create a new tcp socket for each incoming tcp connection and spawn a new server thread
         for thread_count in range(self.num_threads):
             thread_tcp_connection, thread_tcp_addr = self.new_server_tcp_connection.accept()
-            thread = ThreadedServerSession(self.server_name, self.trans_rate, thread_tcp_connection)
+            # control messages are small and answered right away, as asyncio does for its streams
+            thread_tcp_connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            thread = ThreadedServerSession(self.server_name, self.settings, thread_tcp_connection,
+                                           self.server_udp_socket, self.filename, self.segments, self.header,
+                                           self.digest, self.channel)
             print('Thread {} running'.format(thread_count + 1))
             thread_count += 1
             t = threading.Thread(target = thread.send_data)
-            t.setDaemon(True)
+            t.daemon = True
             t.start()
+            streams.append(t)
         
-        main_thread = threading.current_thread()
+        # only wait for the threads of this session, those of other clients are none of its business
+        for t in streams:
+            t.join()
+        self.leave_channel()
+        self.server_udp_socket.close()
+        self.server_tcp_connection.close()
+        self.new_server_tcp_connection.close()
+    
+    def refuse(self, error):
+        """
+        Tells the client the requested file cannot be served, and ends the session
         
-        for thread in threading.enumerate():
-            if thread is main_thread:
-                continue
-            thread.join()
+        :param error: OSError raised opening or reading the file
+        """
+        self.server_tcp_connection.sendall(self.error_message(error))
+        self.leave_channel()
         self.server_tcp_connection.close()
         self.new_server_tcp_connection.close()
+
+
+class MasterAsyncServerSession(BaseMasterServerSession):
+    """Serve a file request and all its streams as tasks on the event loop"""
     
-    def segment_file(self):
-        """ Segment file based on number of threads"""
+    def __init__(self, server_name, settings, reader, writer):
+        """
+        :param server_name: IP address of server_name
+        :param settings: ServerSettings of the server
+        :param reader: StreamReader of the accepted connection
+        :param writer: StreamWriter of the accepted connection
+        """
         
-        if not os.path.exists('./temp'):
-            os.mkdir('./temp')
-        else:
-            rmtree('./temp')
-            os.mkdir('./temp')
+        super(MasterAsyncServerSession, self).__init__(server_name, settings)
+        self.reader = reader
+        self.writer = writer
+        self.accepted = 0
+        self.finished = 0
+        self.all_finished = None
+        self.stream_server = None
+        self.transport = None
+        self.protocol = None
+    
+    async def create_master_task(self):
+        """Handle the incoming connection until all its streams are done"""
         
-        file_size = int(os.stat(self.filename).st_size)
-        chunk_size = ceil(file_size / self.num_threads)
+        try:
+            header = await self.reader.readexactly(MESSAGE_HEADER.size)
+            
+            # clients of the original protocol pickle their request, in a single send
+            if header[0] == PICKLE_PROTOCOL:
+                self.parse_client_info(header + await self.reader.read(1024))
+            else:
+                self.parse_request(header, await self.reader.readexactly(self.request_size(header)))
+            
+            # master segments file based on number of threads
+            self.segment_file()
+        except ProtocolError as e:
+            await self.refuse(e)
+            return
+        except (asyncio.IncompleteReadError, ConnectionError):
+            # the client hung up before its request was complete
+            self.writer.close()
+            return
+        except OSError as e:
+            await self.refuse(e)
+            return
         
-        fs = FileSplit(self.filename, chunk_size, './temp')
-        fs.split()
+        self.all_finished = asyncio.Event()
+        # one datagram endpoint sends the data of every stream, the stream ID in the header tells the client which is
+        # which
+        self.transport, self.protocol = await asyncio.get_running_loop().create_datagram_endpoint(
+            FlowControlledDatagramProtocol, local_addr = (self.server_name, 0), family = socket.AF_INET)
+        # listen for the client threads on an ephemeral port
+        self.stream_server = await asyncio.start_server(self.accept_stream, self.server_name, 0)
         
-        name, ext = os.path.splitext(self.filename)
-        second_last_filename = os.path.join('./temp', "{0}_{1}{2}".format(name, self.num_threads, ext))
-        last_filename = os.path.join('./temp', "{0}_{1}{2}".format(name, self.num_threads + 1, ext))
-        
-        # To get rid of the trailing file
-        if os.path.exists(last_filename):
-            with open(second_last_filename, 'a+b') as f:
-                last_file = open(last_filename, 'r+b')
-                tail = last_file.read()
-                last_file.close()
+        # tell connecting client the new tcp socket to connect to
+        self.writer.write(self.port_message(self.stream_server.sockets[0].getsockname()[1]))
+        await self.writer.drain()
+        # hash in a worker thread so other sessions keep being served meanwhile
+        try:
+            digest = await asyncio.get_running_loop().run_in_executor(None, self.handshake_digest)
+        except OSError as e:
+            self.transport.close()
+            self.stream_server.close()
+            await self.refuse(e)
+            return
+        
+        self.writer.write(digest)
+        await self.writer.drain()
+        
+        await self.all_finished.wait()
+        self.leave_channel()
+        self.transport.close()
+        self.stream_server.close()
+        self.writer.close()
+    
+    async def refuse(self, error):
+        """
+        Tells the client the requested file cannot be served, and ends the session
+        
+        :param error: OSError raised opening or reading the file
+        """
+        self.writer.write(self.error_message(error))
+        await self.writer.drain()
+        self.leave_channel()
+        self.writer.close()
+    
+    async def accept_stream(self, reader, writer):
+        """Serve a client thread on the event loop"""
+        
+        self.accepted += 1
+        print('Thread {} running'.format(self.accepted))
+        
+        # no more client threads to wait for
+        if self.accepted == self.num_threads:
+            self.stream_server.close()
+        
+        stream = AsyncServerSession(self.settings, reader, writer, self.transport, self.protocol, self.filename,
+                                    self.segments, self.header, self.digest, self.channel)
+        try:
+            await stream.send_data()
+        finally:
+            self.finished += 1
+            if self.finished == self.num_threads:
+                self.all_finished.set()
+
+
+class TokenBucketPacer(object):
+    """Token bucket pacing datagrams to the transfer rate, with one sleep per burst instead of one per datagram"""
+    
+    def __init__(self, trans_rate, burst_bytes):
+        """
+        :param trans_rate: transfer rate in Mbps
+        :param burst_bytes: size of the bucket, i.e. number of bytes that may be sent back to back between sleeps
+        """
+        self.rate = float(trans_rate) * 1000000 / 8  # bytes per second
+        self.burst_bytes = burst_bytes
+        self.tokens = burst_bytes
+        self.last_time = time.perf_counter()
+    
+    def reserve(self, num_bytes):
+        """
+        Takes num_bytes worth of tokens out of the bucket
+        
+        The bucket may be overdrawn by up to one burst before the sender has to wait, and the wait only repays the
+        debt, so sleeps happen once per burst and any oversleeping is credited to the next burst rather than lost
+        
+        :param num_bytes: size of the datagrams about to be sent
+        :return: seconds the sender has to wait before sending more
+        """
+        now = time.perf_counter()
+        self.tokens = min(self.burst_bytes, self.tokens + (now - self.last_time) * self.rate)
+        self.last_time = now
+        self.tokens -= num_bytes
+        
+        if self.tokens > -self.burst_bytes:
+            return 0
+        
+        return -self.tokens / self.rate
+    
+    def wait(self, num_bytes):
+        """Takes num_bytes worth of tokens out of the bucket, sleeping if the bucket has run dry"""
+        delay = self.reserve(num_bytes)
+        
+        if delay > 0:
+            time.sleep(delay)
+    
+    def on_loss(self, num_bytes):
+        """Called with the size of the datagrams the client reports lost, the rate stays fixed"""
+        pass
+
+
+class AimdPacer(TokenBucketPacer):
+    """
+    Token bucket whose rate follows the loss reported by the client, so that the sender neither floods the client's
+    receive buffer nor leaves the link idle
+    
+    The rate is cut by a constant factor on each loss event and then grows linearly, regaining the rate it had before
+    the cut within recovery seconds and probing above it until the next loss, never going above the transfer rate.
+    Loss is only taken as a sign of congestion once it is a noticeable share of what was sent, so that a link
+    dropping the odd datagram does not drag the rate down to the minimum
+    """
+    
+    # factor the rate is multiplied by on loss
+    decrease = 0.5
+    # seconds taken to regain the rate given up at a cut
+    recovery = 0.5
+    # reports within this many seconds of a cut are taken as part of the same loss event
+    event_interval = 0.05
+    # lowest rate in Mbps
+    min_rate = 1.0
+    # share of the bytes sent since the last cut that may be lost without cutting the rate, judged once at least
+    # sample_bursts bursts have been sent
+    tolerated_loss = 0.1
+    sample_bursts = 4
+    
+    def __init__(self, trans_rate, burst_bytes):
+        """
+        :param trans_rate: highest transfer rate in Mbps, the one the sender starts at
+        :param burst_bytes: size of the bucket, i.e. number of bytes that may be sent back to back between sleeps
+        """
+        super(AimdPacer, self).__init__(trans_rate, burst_bytes)
+        self.max_rate = self.rate
+        # bytes per second gained every second
+        self.increase = 0.0
+        self.last_cut = 0.0
+        self.last_update = time.perf_counter()
+        # bytes sent and reported lost since the last cut
+        self.sent_bytes = 0
+        self.lost_bytes = 0
+    
+    def reserve(self, num_bytes):
+        self.sent_bytes += num_bytes
+        now = time.perf_counter()
+        self.rate = min(self.max_rate, self.rate + self.increase * (now - self.last_update))
+        self.last_update = now
+        return super(AimdPacer, self).reserve(num_bytes)
+    
+    def on_loss(self, num_bytes):
+        """Cuts the rate once per loss event"""
+        now = time.perf_counter()
+        self.lost_bytes += num_bytes
+        
+        if now - self.last_cut < self.event_interval or self.sent_bytes < self.sample_bursts * self.burst_bytes:
+            return
+        
+        if self.lost_bytes <= self.tolerated_loss * self.sent_bytes:
+            return
+        
+        self.last_cut = now
+        self.sent_bytes = self.lost_bytes = 0
+        self.increase = self.rate * (1 - self.decrease) / self.recovery
+        self.rate = max(self.min_rate * 1000000 / 8, self.rate * self.decrease)
+
+
+class MulticastGroups(object):
+    """MulticastChannels of the files served by multicast, shared by the sessions downloading the same file"""
+    
+    def __init__(self, group, ttl, server_name, settings):
+        """
+        :param group: IP address of the multicast group the blocks are sent to
+        :param ttl: number of routers the datagrams may cross
+        :param server_name: IP address of the interface the datagrams are sent from
+        :param settings: ServerSettings of the server, each channel sending at its transfer rate
+        """
+        self.group = group
+        self.ttl = ttl
+        self.server_name = server_name
+        self.settings = settings
+        # channels by file identity and data header, with the number of sessions using them
+        self.channels = {}
+        self.sessions = {}
+        # shared by the master threads of the threaded engine
+        self.lock = threading.Lock()
+    
+    def join(self, filename, header):
+        """
+        :param filename: path of the file requested by a multicast session
+        :param header: DataHeader negotiated with the client
+        :return: MulticastChannel sending the blocks of the file, started if no other session is downloading it
+        """
+        # datagrams of another block size would be taken for blocks of the file by the receivers
+        key = (file_identity(filename), header.block_size)
+        
+        with self.lock:
+            if key not in self.channels:
+                self.channels[key] = MulticastChannel(self.group, self.ttl, self.server_name, self.settings, filename,
+                                                      header)
+                self.channels[key].start()
+                self.sessions[key] = 0
+            
+            self.sessions[key] += 1
+            return self.channels[key]
+    
+    def leave(self, channel):
+        """Stops the channel once no session uses it any more"""
+        with self.lock:
+            key = next(key for key, value in self.channels.items() if value is channel)
+            self.sessions[key] -= 1
+            
+            if self.sessions[key]:
+                return
+            
+            del self.channels[key], self.sessions[key]
+        
+        channel.stop()
+
+
+class MulticastChannel(object):
+    """
+    Sends the blocks of a file asked for by the streams of every multicast session downloading it to a group
+    
+    A block asked for by several streams before it is sent goes out once for all of them, so receivers downloading
+    the file at the same time cost the server no more than one. Each stream is told once its blocks are sent, and then
+    deals with its client's NACKs on its own, repairing by unicast
+    """
+    
+    def __init__(self, group, ttl, server_name, settings, filename, header):
+        """
+        :param group: IP address of the multicast group
+        :param ttl: number of routers the datagrams may cross
+        :param server_name: IP address of the interface the datagrams are sent from
+        :param settings: ServerSettings of the server
+        :param filename: name of the file
+        :param header: DataHeader of the sessions using the channel
+        """
+        self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+        self.udp_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(server_name))
+        # the port the channel sends from is free on this host, it is the group port of the channel
+        self.udp_socket.bind((server_name, 0))
+        self.address = (group, self.udp_socket.getsockname()[1])
+        self.batch_size = settings.batch_datagrams(header)
+        self.sender = BatchSender(self.udp_socket, self.address, self.batch_size, header.size + header.block_size)
+        self.pacer = TokenBucketPacer(settings.trans_rate, settings.burst_bytes(header))
+        self.block_cache = settings.block_cache
+        self.filename = filename
+        self.header = header
+        # (offset, length, tickets) by (stream ID, block ID) of the blocks waiting to be sent, in the order asked for;
+        # a ticket is a [number of blocks left to send, callback] list
+        self.wanted = OrderedDict()
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.thread = threading.Thread(target = self.run)
+        self.thread.daemon = True
+    
+    def start(self):
+        self.thread.start()
+    
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+    
+    def submit(self, stream_id, offset, length, block_ids, on_sent):
+        """
+        Queues blocks of a segment, leaving out those already queued for another stream
+        
+        :param stream_id: stream ID of the segment
+        :param offset: offset of the segment in the file
+        :param length: length of the segment
+        :param block_ids: IDs of the blocks to send
+        :param on_sent: called from the channel's thread once every block is sent
+        """
+        if not block_ids:
+            on_sent()
+            return
+        
+        ticket = [len(block_ids), on_sent]
+        
+        with self.condition:
+            for idx in block_ids:
+                self.wanted.setdefault((stream_id, idx), (offset, length, []))[2].append(ticket)
+            
+            self.condition.notify()
+    
+    def run(self):
+        """Sends the queued blocks until the channel is stopped"""
+        block_size = self.header.block_size
+        
+        with open(self.filename, 'rb') as f:
+            identity = self.block_cache.identify(self.filename)
+            
+            while True:
+                with self.condition:
+                    while not self.wanted and not self.stopped:
+                        self.condition.wait()
+                    
+                    if self.stopped:
+                        break
+                    
+                    batch = [self.wanted.popitem(last = False) for _ in range(min(self.batch_size, len(self.wanted)))]
                 
-                f.write(tail)
-                f.close()
+                datagrams = [self.header.pack(idx, stream_id) +
+                             self.block_cache.read(identity, f, offset + idx * block_size,
+                                                   min(block_size, length - idx * block_size))
+                             for (stream_id, idx), (offset, length, _) in batch]
+                self.sender.send(datagrams)
+                self.pacer.wait(sum(len(data) for data in datagrams))
+                
+                for _, (_, _, tickets) in batch:
+                    for ticket in tickets:
+                        ticket[0] -= 1
+                        
+                        if ticket[0] == 0:
+                            ticket[1]()
+        
+        self.udp_socket.close()
+
+
+class BaseServerSession(object):
+    """Segment bookkeeping shared by the threaded and the asyncio sessions sending a segment to a client thread"""
+    
+    def __init__(self, settings, filename, segments, header, digest, channel = None):
+        """
+        :param settings: ServerSettings of the server
+        :param filename: name of the original file the segments are taken from
+        :param segments: mapping of segment name to its (stream ID, offset, length) in the file
+        :param header: DataHeader negotiated with the client
+        :param digest: FileDigest of the file
+        :param channel: MulticastChannel sending the first round of each segment, None to send it by unicast
+        """
+        
+        self.buffer_size = header.block_size
+        # datagrams are paced to the user-specified transfer rate, or below it as long as the client reports loss
+        pacer_class = AimdPacer if settings.rate_control == 'aimd' else TokenBucketPacer
+        self.pacer = pacer_class(settings.trans_rate, settings.burst_bytes(header))
+        self.batch_size = settings.batch_datagrams(header)
+        self.client_name = ''
+        self.client_udp_port = 0
+        self.filename = filename
+        self.segments = segments
+        self.header = header
+        self.digest = digest
+        self.block_cache = settings.block_cache
+        self.channel = channel
+        # the original header has no flags to tell parity blocks from data blocks
+        self.parity_blocks = settings.parity_blocks if header.version > 1 else 0
+        self.compression = settings.compression
+        # compresses the blocks with the codec picked among those the client thread decompresses
+        self.compressor = BlockCompressor(CODEC_NONE)
+        # identity of the file being read, as of when the stream opened it
+        self.file_identity = None
+        # segments served over the stream, only the first one is logged
+        self.segments_sent = 0
+        self.stream_id = 0
+        self.segment_offset = 0
+        self.segment_length = 0
+        # blocks the client thread reported lost while the current round is being sent
+        self.repairs = deque()
+    
+    def parse_attach(self, body):
+        """Reads the address the client thread receives its data on, and the codecs it decompresses, from its ATTACH"""
+        self.client_udp_port, codecs = ATTACH_BODY.unpack_from(body)
+        self.compressor = BlockCompressor(pick_codec(self.compression, codecs))
+        self.client_name = body[ATTACH_BODY.size:].decode('utf-8')
+    
+    def segment_name(self, segment_num):
+        """
+        :param segment_num: number of a segment, as requested in a REQUEST
+        :return: name of the segment, as requested by clients of the original protocol
+        """
+        name, ext = os.path.splitext(self.filename)
+        return "{0}_{1}{2}".format(name, segment_num, ext)
+    
+    def select_segment(self, segment_name):
+        """
+        Looks up the segment requested by the client thread
+        
+        :param segment_name: name of the requested segment
+        :return: number of blocks in the segment, 0 if it cannot be served
+        """
+        if not self.segments_sent:
+            print('File requested {}'.format(segment_name))
+        
+        # check whether the segment exists in the requested file
+        if segment_name not in self.segments:
+            print("Server: File does not exist. Continue waiting for filename")
+            return 0
+        
+        self.stream_id, self.segment_offset, self.segment_length = self.segments[segment_name]
+        blocks = ceil(self.segment_length / self.buffer_size)
+        
+        if blocks > self.header.max_blocks:
+            print("Server: Segment has too many blocks for header version {}".format(self.header.version))
+            return 0
+        
+        return blocks
+    
+    def segment_reply(self, blocks):
+        """
+        :param blocks: number of blocks in the requested segment, 0 if it cannot be served
+        :return: SEGMENT message answering a segment request, followed by the digests of the segment's pieces, the
+        number of blocks as text for clients of the original protocol
+        """
+        if self.header.version == 1:
+            return str(blocks).encode('utf-8')
+        
+        leaves = self.digest.segment_leaves(self.segment_offset, self.segment_length) if blocks else []
+        return pack_message(SEGMENT, SEGMENT_BODY.pack(blocks, self.segment_offset, self.digest.size,
+                                                       len(self.segments)) + b''.join(leaves))
+    
+    def done_signal(self):
+        """Signal sent at the end of each round of transmission, a DONE message or the text DONE for the original one"""
+        return 'DONE'.encode('utf-8') if self.header.version == 1 else pack_message(DONE)
+    
+    def blocks_of(self, ranges):
+        """
+        :param ranges: (start, end) block ranges asked for by the client, end exclusive
+        :return: IDs of the blocks to send, in order, those past the end of the segment left out
+        """
+        blocks = ceil(self.segment_length / self.buffer_size)
+        clamped = []
+        
+        # clients send sorted ranges that do not overlap, so that no block is asked for twice
+        for start, end in ranges:
+            if start > end or (clamped and start < clamped[-1][1]):
+                raise ProtocolError('Client asked for blocks {} to {} out of order'.format(start, end))
             
-            os.remove(last_filename)
+            if start < blocks:
+                clamped.append((start, min(end, blocks)))
         
-        return
+        if len(clamped) == 1:
+            return range(*clamped[0])
+        
+        return [idx for start, end in clamped for idx in range(start, end)]
     
-    @staticmethod
-    def md5(filename):
-        """To calculate a MD5 hash for client to check integrity"""
+    def report_loss(self, blocks):
+        """Lets the pacer know how many blocks the client thread lost"""
+        self.pacer.on_loss(blocks * (self.header.size + self.buffer_size))
+    
+    def with_parity(self, block_ids):
+        """
+        Follows the last block of each window of parity_blocks blocks sent in a round with the parity of the window, so
+        that the client rebuilds any one block of the window it lost without asking for it again
         
-        hash_md5 = hashlib.md5()
+        :param block_ids: IDs of the blocks to send, in order
+        :return: the block IDs, with the parity of window w given as ~w
+        """
+        if not self.parity_blocks:
+            return block_ids
         
-        with open(filename, 'rb') as f:
-            for chunk in iter(lambda: f.read(4096), b''):
-                hash_md5.update(chunk)
+        items = []
+        
+        for i, idx in enumerate(block_ids):
+            items.append(idx)
+            window = idx // self.parity_blocks
+            
+            if i + 1 == len(block_ids) or block_ids[i + 1] // self.parity_blocks != window:
+                items.append(~window)
+        
+        return items
+    
+    def batches(self, block_ids):
+        """
+        Splits the blocks of a round into batches, putting the repairs asked for during the round ahead of the rest
         
-        return hash_md5.digest()
+        :param block_ids: IDs of the blocks to send, in order
+        :return: generator of lists of block IDs, at most batch_size each
+        """
+        block_ids = self.with_parity(block_ids)
+        sent = 0
+        # repairs reported before the round started are covered by the blocks of the round
+        self.repairs.clear()
+        
+        while True:
+            batch = [self.repairs.popleft() for _ in range(min(len(self.repairs), self.batch_size))]
+            fresh = block_ids[sent:sent + self.batch_size - len(batch)]
+            sent += len(fresh)
+            batch.extend(fresh)
+            
+            if not batch:
+                return
+            
+            yield batch
+    
+    def open_file(self):
+        """Opens the file the segments are taken from, noting its identity for the block cache"""
+        f = open(self.filename, 'rb')
+        self.file_identity = self.block_cache.identify(self.filename)
+        return f
+    
+    def read_block(self, f, idx):
+        """Reads block idx of this thread's segment from the open file f by offset, or from the block cache"""
+        start = idx * self.buffer_size
+        return self.block_cache.read(self.file_identity, f, self.segment_offset + start,
+                                     min(self.buffer_size, self.segment_length - start))
+    
+    def parity_datagram(self, f, window):
+        """Frames the parity of a window of blocks of the segment, as the XOR of the blocks"""
+        start = window * self.parity_blocks
+        end = min(start + self.parity_blocks, ceil(self.segment_length / self.buffer_size))
+        parity = xor_blocks([self.read_block(f, idx) for idx in range(start, end)], self.buffer_size)
+        return self.header.pack(start, self.stream_id, FLAG_PARITY | (end - start - 1)) + parity
+    
+    def make_datagrams(self, f, block_ids):
+        """
+        Frames the given blocks of the segment, each one a header with the segment id followed by the data, compressing
+        runs of consecutive blocks together into a datagram when it is worth it
+        """
+        datagrams = []
+        i = 0
+        
+        while i < len(block_ids):
+            idx = block_ids[i]
+            
+            if idx < 0:
+                datagrams.append(self.parity_datagram(f, ~idx))
+                i += 1
+                continue
+            
+            run = 1
+            while run < MAX_RUN_BLOCKS and i + run < len(block_ids) and block_ids[i + run] == idx + run:
+                run += 1
+            
+            codec, payload, count = self.compressor.compress([self.read_block(f, j) for j in range(idx, idx + run)],
+                                                             self.buffer_size)
+            datagrams.append(self.header.pack(idx, self.stream_id, codec | (count - 1) << RUN_SHIFT) + payload)
+            i += count
+        
+        return datagrams
 
 
-class ThreadedServerSession(object):
+class ThreadedServerSession(BaseServerSession):
     """Individual threads spawned for sending file segment to client thread"""
     
-    def __init__(self, server_name, trans_rate, thread_tcp_connection):
+    def __init__(self, server_name, settings, thread_tcp_connection, server_udp_socket, filename, segments, header,
+                 digest, channel = None):
         """
         :param server_name: ip address of server
-        :param trans_rate: user-specified transfer rate
+        :param settings: ServerSettings of the server
         :param thread_tcp_connection: spawned tcp socket with accepted connection
+        :param server_udp_socket: udp socket shared by all threads of the session
+        :param filename: name of the original file the segments are taken from
+        :param segments: mapping of segment name to its (stream ID, offset, length) in the file
+        :param header: DataHeader negotiated with the client
+        :param digest: FileDigest of the file
+        :param channel: MulticastChannel sending the first round of each segment, None to send it by unicast
         """
         
-        self.server_udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.server_udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        super(ThreadedServerSession, self).__init__(settings, filename, segments, header, digest, channel)
+        self.server_udp_socket = server_udp_socket
         self.server_name = server_name
-        self.buffer_size = 1024
-        # sleep_time is calculated based on user-specified transfer rate
-        self.sleep_time = 1 / ((float(trans_rate) * 1000000 / 8) / (self.buffer_size + 2))  # without transmission time
-        self.client_name = ''
-        self.client_udp_port = 0
-        self.filename = ''
         self.thread_tcp_connection = thread_tcp_connection
     
     def close_connection(self):
         """Close any open sockets"""
         print('Closing thread connection')
-        self.server_udp_socket.close()
-        # self.thread_tcp_connection.close()
+        # the udp socket is shared with the other threads and closed by the master
+        self.thread_tcp_connection.close()
+    
+    def send_blocks(self, sender, f, block_ids):
+        """
+        Sends the given blocks of the segment to the client, batch_size datagrams per system call
+        
+        :param sender: BatchSender addressed to the client thread
+        :param f: open file the segment is taken from
+        :param block_ids: IDs of the blocks to send, in order
+        """
+        for batch in self.batches(block_ids):
+            datagrams = self.make_datagrams(f, batch)
+            sender.send(datagrams)
+            self.pacer.wait(sum(len(data) for data in datagrams))
+            
+            if self.header.version > 1:
+                self.poll_repairs()
+    
+    def poll_repairs(self):
+        """Queues the blocks the client thread reported lost since the last batch, without waiting for any"""
+        while select.select([self.thread_tcp_connection], [], [], 0)[0]:
+            repairs = self.blocks_of(self.read_nack()[1])
+            self.repairs.extend(repairs)
+            self.report_loss(len(repairs))
+    
+    def recv_request(self):
+        """
+        Receives the next segment request of the client thread, a segment number or the segment name for the original
+        protocol
+        
+        :return: name of the requested segment, empty if the client thread hung up
+        """
+        if self.header.version == 1:
+            return self.thread_tcp_connection.recv(1024).decode('utf-8')
+        
+        try:
+            return self.segment_name(REQUEST_BODY.unpack(recv_message(self.thread_tcp_connection, REQUEST))[0])
+        except ConnectionError:
+            return ''
+    
+    def read_nack(self):
+        """
+        Receives a NACK of the client thread
+        
+        :return: (True if it was sent during the round, missing block ranges)
+        """
+        encoding, size = NACK_HEADER.unpack(recv_exactly(self.thread_tcp_connection, NACK_HEADER.size))
+        return bool(encoding & NACK_SELECTIVE), unpack_nack(encoding, recv_exactly(self.thread_tcp_connection, size))
+    
+    def recv_nack(self):
+        """Receives the blocks missed by the client thread in a round, as ranges"""
+        while True:
+            selective, ranges = self.read_nack()
+            
+            # reports crossing the DONE signal are covered by the answer to it
+            if not selective:
+                return ranges
     
     def send_data(self):
         """Main function for sending data for client"""
         # receive client udp port number
-        client_addr = self.thread_tcp_connection.recv(1024)
-        self.client_name, self.client_udp_port = pickle.loads(client_addr)
+        if self.header.version == 1:
+            self.client_name, self.client_udp_port = load_legacy(self.thread_tcp_connection.recv(1024))
+        else:
+            self.parse_attach(recv_message(self.thread_tcp_connection, ATTACH))
+        
+        sender = BatchSender(self.server_udp_socket, (self.client_name, self.client_udp_port),
+                             self.batch_size, self.header.size + self.buffer_size)
+        
+        # a client thread downloads one segment after another over the same connection
         print("Server: Awaiting filename from client")
+        with self.open_file() as f:
+            while self.send_segment(sender, f):
+                pass
+        
+        self.close_connection()
+    
+    def send_segment(self, sender, f):
+        """
+        Serves a segment request of the client thread
+        
+        :param sender: BatchSender addressed to the client thread
+        :param f: open file the segments are taken from
+        :return: True if the client thread may request another segment
+        """
         while True:
-            # receive requested file name
-            self.filename = self.thread_tcp_connection.recv(1024).decode('utf-8')
-            self.filename = 'temp/' + self.filename
-            print('File requested {}'.format(self.filename))
-            
-            # check whether file exists in current directory
-            if os.path.isfile(self.filename):
-                file_size = os.path.getsize(self.filename)
-                blocks = ceil(file_size / 1024)
-                self.thread_tcp_connection.send(str(blocks).encode('utf-8'))
+            # receive requested segment name
+            segment_name = self.recv_request()
+            
+            # client thread hung up
+            if not segment_name:
+                return False
+            
+            blocks = self.select_segment(segment_name)
+            self.thread_tcp_connection.sendall(self.segment_reply(blocks))
+            
+            if blocks:
                 break
+        
+        try:
+            first_round = range(blocks)
+            
+            # the client asks for the blocks it is missing, e.g. when resuming a download
+            if self.header.version > 1:
+                first_round = self.blocks_of(self.read_nack()[1])
+            
+            if not self.segments_sent:
+                print("Server: Sending data over...")
+            self.segments_sent += 1
+            
+            # the first round of a multicast session goes to the group, along with those of the other receivers
+            if self.channel is not None:
+                sent = threading.Event()
+                self.channel.submit(self.stream_id, self.segment_offset, self.segment_length, first_round, sent.set)
+                sent.wait()
             else:
-                self.thread_tcp_connection.send('0'.encode('utf-8'))
-                print("Server: File does not exist. Continue waiting for filename")
+                self.send_blocks(sender, f, first_round)
+            while True:
+                # once done, send a DONE signal and wait for next message
+                self.thread_tcp_connection.send(self.done_signal())
+                
+                # wait for id of missing segments from client
+                if self.header.version == 1:
+                    missing = [idx for idx in self.header.unpack_indices(self.thread_tcp_connection.recv(1024))
+                               if idx < blocks]
+                else:
+                    missing = self.blocks_of(self.recv_nack())
+                
+                # clients of the original protocol hang up once they have every block, others send an empty NACK
+                if len(missing) == 0:
+                    return self.header.version > 1
+                
+                self.report_loss(len(missing))
+                
+                # blast out missing segments to client, re-read from the file by offset so that
+                # nothing but the current batch is ever held in memory
+                self.send_blocks(sender, f, missing)
+        except socket.error as e:
+            print(e)
+            return False
+
+
+class FlowControlledDatagramProtocol(asyncio.DatagramProtocol):
+    """Datagram protocol letting the sender wait while the transport's buffer is full"""
+    
+    def __init__(self):
+        self.writable = asyncio.Event()
+        self.writable.set()
+    
+    def pause_writing(self):
+        self.writable.clear()
+    
+    def resume_writing(self):
+        self.writable.set()
+    
+    def error_received(self, exc):
+        # e.g. ICMP port unreachable, missing packets are recovered by the NACK rounds anyway
+        pass
+
+
+class AsyncServerSession(BaseServerSession):
+    """Task sending a file segment to a client thread on the event loop"""
+    
+    def __init__(self, settings, reader, writer, transport, protocol, filename, segments, header, digest,
+                 channel = None):
+        """
+        :param settings: ServerSettings of the server
+        :param reader: StreamReader of the accepted connection
+        :param writer: StreamWriter of the accepted connection
+        :param transport: datagram transport shared by all streams of the session
+        :param protocol: FlowControlledDatagramProtocol of the transport
+        :param filename: name of the original file the segments are taken from
+        :param segments: mapping of segment name to its (stream ID, offset, length) in the file
+        :param header: DataHeader negotiated with the client
+        :param digest: FileDigest of the file
+        :param channel: MulticastChannel sending the first round of each segment, None to send it by unicast
+        """
         
-        with open(self.filename, 'rb') as f:
-            print("Server: Sending data over...")
-            # for temporary storage of bytes from file for simple retrieval
-            bytes_array = b''
-            data = f.read(self.buffer_size)
-            segment_id = 0  # use 16bits/2bytes (0 to 65535) for segment id
-            while data:
-                segment_id_bytes = segment_id.to_bytes(2, byteorder = 'big')
-                # sending over 2 bytes of segment id + 1024 bytes of data
-                data = segment_id_bytes + data
-                bytes_array += data
-                self.server_udp_socket.sendto(data, (self.client_name, self.client_udp_port))
-                # ^ this code shows a substantial increase in time taken. might be due to client side taking time as
-                # well
-                time.sleep(self.sleep_time)
-                data = f.read(self.buffer_size)
-                segment_id += 1
+        super(AsyncServerSession, self).__init__(settings, filename, segments, header, digest, channel)
+        self.reader = reader
+        self.writer = writer
+        self.transport = transport
+        self.protocol = protocol
+        # answers to the DONE signals of the current segment, read along with the repairs
+        self.nacks = None
+    
+    async def send_blocks(self, f, block_ids):
+        """
+        Sends the given blocks of the segment to the client, yielding to the other tasks after every batch
+        
+        :param f: open file the segment is taken from
+        :param block_ids: IDs of the blocks to send, in order
+        """
+        for batch in self.batches(block_ids):
+            datagrams = self.make_datagrams(f, batch)
+            
+            for data in datagrams:
+                self.transport.sendto(data, (self.client_name, self.client_udp_port))
+            
+            await self.protocol.writable.wait()
+            await asyncio.sleep(self.pacer.reserve(sum(len(data) for data in datagrams)))
+    
+    @staticmethod
+    def resolve(future):
+        """Marks a future done, unless the task waiting for it was cancelled"""
+        if not future.done():
+            future.set_result(None)
+    
+    async def recv_message(self, expected):
+        """
+        :param expected: type of the message the client thread must send next
+        :return: body of the message
+        """
+        return await self.reader.readexactly(message_size(await self.reader.readexactly(MESSAGE_HEADER.size), expected))
+    
+    async def recv_request(self):
+        """
+        Receives the next segment request of the client thread, a segment number or the segment name for the original
+        protocol
+        
+        :return: name of the requested segment, empty if the client thread hung up
+        """
+        if self.header.version == 1:
+            return (await self.reader.read(1024)).decode('utf-8')
+        
+        try:
+            return self.segment_name(REQUEST_BODY.unpack(await self.recv_message(REQUEST))[0])
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return ''
+    
+    async def read_nack(self):
+        """
+        Receives a NACK of the client thread
+        
+        :return: (True if it was sent during the round, missing block ranges)
+        """
+        encoding, size = NACK_HEADER.unpack(await self.reader.readexactly(NACK_HEADER.size))
+        return bool(encoding & NACK_SELECTIVE), unpack_nack(encoding, await self.reader.readexactly(size))
+    
+    async def recv_nack(self):
+        """Receives the blocks missed by the client thread in a round, as ranges"""
+        ranges = await self.nacks.get()
+        
+        if ranges is None:
+            raise ConnectionError('Client thread hung up')
+        
+        return ranges
+    
+    async def read_repairs(self):
+        """
+        Reads the NACKs of the client thread for as long as the segment is being sent, queueing the blocks reported
+        lost during a round and passing the answers to DONE signals on to recv_nack
+        """
+        try:
+            while True:
+                selective, ranges = await self.read_nack()
+                
+                if selective:
+                    repairs = self.blocks_of(ranges)
+                    self.repairs.extend(repairs)
+                    self.report_loss(len(repairs))
+                    continue
+                
+                await self.nacks.put(ranges)
+                
+                # the segment is complete, the next message is a segment request
+                if not ranges:
+                    return
+        except (asyncio.IncompleteReadError, ConnectionError, OSError):
+            await self.nacks.put(None)
+    
+    async def send_data(self):
+        """Main coroutine for sending data for client"""
+        # receive client udp port number
+        if self.header.version == 1:
+            self.client_name, self.client_udp_port = load_legacy(await self.reader.read(1024))
+        else:
+            self.parse_attach(await self.recv_message(ATTACH))
+        
+        # a client thread downloads one segment after another over the same connection
+        print("Server: Awaiting filename from client")
+        with self.open_file() as f:
+            while await self.send_segment(f):
+                pass
+        
+        print('Closing thread connection')
+        self.writer.close()
+    
+    async def send_segment(self, f):
+        """
+        Serves a segment request of the client thread
+        
+        :param f: open file the segments are taken from
+        :return: True if the client thread may request another segment
+        """
+        while True:
+            # receive requested segment name
+            segment_name = await self.recv_request()
+            
+            # client thread hung up
+            if not segment_name:
+                return False
+            
+            blocks = self.select_segment(segment_name)
+            self.writer.write(self.segment_reply(blocks))
+            await self.writer.drain()
+            
+            if blocks:
+                break
+        
+        repairs = None
+        
+        try:
+            first_round = range(blocks)
+            
+            # the client asks for the blocks it is missing, e.g. when resuming a download, and reports lost blocks
+            # while they are being sent
+            if self.header.version > 1:
+                first_round = self.blocks_of((await self.read_nack())[1])
+                self.nacks = asyncio.Queue()
+                repairs = asyncio.ensure_future(self.read_repairs())
+            
+            if not self.segments_sent:
+                print("Server: Sending data over...")
+            self.segments_sent += 1
+            
+            # the first round of a multicast session goes to the group, along with those of the other receivers
+            if self.channel is not None:
+                loop = asyncio.get_running_loop()
+                sent = loop.create_future()
+                self.channel.submit(self.stream_id, self.segment_offset, self.segment_length, first_round,
+                                    lambda: loop.call_soon_threadsafe(self.resolve, sent))
+                await sent
+            else:
+                await self.send_blocks(f, first_round)
             while True:
                 # once done, send a DONE signal and wait for next message
-                self.thread_tcp_connection.send('DONE'.encode('utf-8'))
-                try:
-                    # wait for id of missing segments from client
-                    missing_bytes = self.thread_tcp_connection.recv(1024)
-                    missing = [int.from_bytes(missing_bytes[i: i + 2], byteorder = 'big') for i in
-                               range(0, len(missing_bytes), 2)]
-                    if len(missing) == 0:
-                        break
-                    else:
-                        for idx in missing:
-                            # blast out missing segments to client
-                            self.server_udp_socket.sendto(bytes_array[idx * 1026:(idx + 1) * 1026],
-                                                          (self.client_name, self.client_udp_port))
-                            time.sleep(self.sleep_time)
-                except socket.error as e:
-                    print(e)
-        self.close_connection()
+                self.writer.write(self.done_signal())
+                await self.writer.drain()
+                
+                # wait for id of missing segments from client
+                if self.header.version == 1:
+                    missing = [idx for idx in self.header.unpack_indices(await self.reader.read(1024)) if idx < blocks]
+                else:
+                    missing = self.blocks_of(await self.recv_nack())
+                
+                # clients of the original protocol hang up once they have every block, others send an empty NACK
+                if len(missing) == 0:
+                    return self.header.version > 1
+                
+                self.report_loss(len(missing))
+                
+                # blast out missing segments to client, re-read from the file by offset
+                await self.send_blocks(f, missing)
+        except (asyncio.IncompleteReadError, ConnectionError, OSError) as e:
+            print(e)
+            return False
+        finally:
+            if repairs is not None:
+                repairs.cancel()
 
 
 ####################################################################################################################
@@ -248,9 +1346,41 @@ class ThreadedServerSession(object):
 @click.command()
 @click.option('-s', '--server-name', help = 'Server IP address', required = True)
 @click.option('--server-tcp-port', help = 'Server TCP Port', default = 12001)
-@click.option('-r', '--trans-rate', help = 'Transmission Rate in Mbps', default = 10000.0)
-def start_server(server_name, server_tcp_port, trans_rate):
-    server_session = MainServerSession(server_name, server_tcp_port, trans_rate)
+@click.option('-r', '--trans-rate', help = 'Transmission Rate in Mbps, the Highest One Under AIMD', default = 10000.0)
+@click.option('--rate-control', help = 'Adapt the Rate of Each Stream to the Loss Reported by the Client, or Keep It',
+              type = click.Choice(['aimd', 'fixed']), default = 'aimd')
+@click.option('--burst-size', help = 'Kilobytes Sent Back to Back Between Pacing Sleeps', default = 32)
+@click.option('--batch-size', help = 'Kilobytes per System Call, 1 to Disable Batching', default = 32)
+@click.option('--engine', help = 'Thread per Connection and Stream, or One asyncio Event Loop',
+              type = click.Choice(['threaded', 'asyncio']), default = 'threaded')
+@click.option('--digest-cache', help = 'Directory Keeping the MD5 of Served Files Across Restarts, Empty to Disable',
+              default = '.mtd_digests')
+@click.option('--digest-cache-size', help = 'Number of MD5 Digests Kept', default = 256)
+@click.option('--block-cache-size', help = 'Megabytes of File Data Kept in Memory for All Clients, 0 to Disable',
+              default = 256)
+@click.option('--multicast-group', help = 'Group Address Serving Clients Joining by Multicast, Empty to Disable',
+              default = '')
+@click.option('--multicast-ttl', help = 'Number of Routers Multicast Datagrams May Cross', default = 1)
+@click.option('--fec-ratio', help = 'Parity Blocks Sent per Block of Data, 0 to Disable', default = 0.0)
+@click.option('--compression', help = 'Codec Compressing the Blocks for Clients Supporting It',
+              type = click.Choice(sorted(CODEC_NAMES)), default = 'none')
+def start_server(server_name, server_tcp_port, trans_rate, rate_control, burst_size, batch_size, engine, digest_cache,
+                 digest_cache_size, block_cache_size, multicast_group, multicast_ttl, fec_ratio, compression):
+    # one parity block per window of blocks, as many as fit in its flags at most
+    parity_blocks = min(max(1, round(1 / fec_ratio)), MAX_PARITY_BLOCKS) if fec_ratio > 0 else 0
+    codec = CODEC_NAMES[compression]
+    
+    if codec != CODEC_NONE and not supported_codecs() & (1 << codec):
+        print('Server: {} is not installed, compressing with zlib instead'.format(compression))
+    
+    settings = ServerSettings(trans_rate, rate_control, burst_size, batch_size,
+                              DigestCache(digest_cache, digest_cache_size), BlockCache(block_cache_size * 1024 * 1024),
+                              parity_blocks = parity_blocks, compression = codec)
+    
+    if multicast_group:
+        settings.multicast = MulticastGroups(multicast_group, multicast_ttl, server_name, settings)
+    
+    server_session = MainServerSession(server_name, server_tcp_port, settings, engine)
     server_session.initialize_connection()
     server_session.close_connection()
 
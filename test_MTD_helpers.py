@@ -0,0 +1,212 @@
+import hashlib
+import os
+import unittest
+
+from MTD_client import BlockBitmap
+from MTD_compress import BlockCompressor, decompress_blocks
+from MTD_digest import merkle_root
+from MTD_protocol import (CODEC_NONE, CODEC_ZLIB, MAX_BLOCK_SIZE, MIN_BLOCK_SIZE, NACK_BITMAP, NACK_HEADER,
+                          NACK_RANGES, NACK_SELECTIVE, DataHeader, ProtocolError, negotiate_block_size, pack_nack,
+                          unpack_nack, xor_blocks)
+from MTD_server import BaseServerSession, ServerSettings
+
+
+def nack_round_trip(ranges, selective = False):
+    """
+    :return: (encoding, ranges) read back from the NACK packed for the ranges
+    """
+    nack = pack_nack(ranges, selective)
+    encoding, size = NACK_HEADER.unpack_from(nack)
+    body = nack[NACK_HEADER.size:]
+    assert len(body) == size
+    return encoding, unpack_nack(encoding, body)
+
+
+class NackTest(unittest.TestCase):
+    
+    def test_no_missing_blocks(self):
+        self.assertEqual(nack_round_trip([]), (NACK_RANGES, []))
+    
+    def test_burst_is_sent_as_ranges(self):
+        ranges = [(10, 5000), (70000, 80000)]
+        self.assertEqual(nack_round_trip(ranges), (NACK_RANGES, ranges))
+    
+    def test_scattered_loss_is_sent_as_bitmap(self):
+        ranges = [(idx, idx + 1) for idx in range(3, 200, 3)]
+        self.assertEqual(nack_round_trip(ranges), (NACK_BITMAP, ranges))
+    
+    def test_bitmap_keeps_adjacent_runs_apart(self):
+        ranges = [(0, 2), (3, 4), (5, 9), (15, 16)]
+        self.assertEqual(nack_round_trip(ranges)[1], ranges)
+    
+    def test_selective_flag(self):
+        for ranges in ([(1, 2)], [(idx, idx + 1) for idx in range(0, 100, 2)]):
+            encoding, unpacked = nack_round_trip(ranges, selective = True)
+            self.assertTrue(encoding & NACK_SELECTIVE)
+            self.assertEqual(unpacked, ranges)
+    
+    def test_32_bit_bounds(self):
+        ranges = [(0xFFFFFFF0, 0xFFFFFFFF)]
+        self.assertEqual(nack_round_trip(ranges)[1], ranges)
+
+
+class BlockBitmapTest(unittest.TestCase):
+    
+    def test_nothing_received(self):
+        self.assertEqual(BlockBitmap(13).missing_ranges(), [(0, 13)])
+    
+    def test_everything_received(self):
+        bitmap = BlockBitmap(13)
+        for idx in range(13):
+            bitmap.mark(idx)
+        
+        self.assertTrue(bitmap.is_complete())
+        self.assertEqual(bitmap.missing_ranges(), [])
+    
+    def test_gaps_across_bytes(self):
+        bitmap = BlockBitmap(40)
+        for idx in list(range(0, 5)) + list(range(7, 30)) + [31]:
+            bitmap.mark(idx)
+        
+        self.assertEqual(bitmap.missing_ranges(), [(5, 7), (30, 31), (32, 40)])
+    
+    def test_mark_twice(self):
+        bitmap = BlockBitmap(8)
+        self.assertTrue(bitmap.mark(3))
+        self.assertFalse(bitmap.mark(3))
+        self.assertEqual(bitmap.count, 1)
+    
+    def test_clear(self):
+        bitmap = BlockBitmap(16, b'\xff\xff')
+        bitmap.clear(4, 12)
+        self.assertEqual(bitmap.count, 8)
+        self.assertEqual(bitmap.missing_ranges(), [(4, 12)])
+    
+    def test_bits_past_the_end_are_dropped(self):
+        bitmap = BlockBitmap(10, b'\xff\xff\xff')
+        self.assertEqual(bitmap.count, 10)
+        self.assertTrue(bitmap.is_complete())
+
+
+class NegotiateBlockSizeTest(unittest.TestCase):
+    
+    def test_powers_of_two(self):
+        self.assertEqual(negotiate_block_size(1024), 1024)
+        self.assertEqual(negotiate_block_size(8192), 8192)
+    
+    def test_rounds_down(self):
+        self.assertEqual(negotiate_block_size(1472), 1024)
+        self.assertEqual(negotiate_block_size(9000), 8192)
+    
+    def test_limits(self):
+        self.assertEqual(negotiate_block_size(0), MIN_BLOCK_SIZE)
+        self.assertEqual(negotiate_block_size(100), MIN_BLOCK_SIZE)
+        self.assertEqual(negotiate_block_size(1 << 31), MAX_BLOCK_SIZE)
+
+
+class MerkleRootTest(unittest.TestCase):
+    
+    @staticmethod
+    def digest(data):
+        return hashlib.md5(data).digest()
+    
+    def test_no_pieces(self):
+        self.assertEqual(merkle_root([]), self.digest(b''))
+    
+    def test_single_piece(self):
+        self.assertEqual(merkle_root([self.digest(b'a')]), self.digest(b'a'))
+    
+    def test_odd_piece_is_promoted(self):
+        a, b, c = self.digest(b'a'), self.digest(b'b'), self.digest(b'c')
+        self.assertEqual(merkle_root([a, b, c]), self.digest(self.digest(a + b) + c))
+    
+    def test_order_matters(self):
+        a, b = self.digest(b'a'), self.digest(b'b')
+        self.assertNotEqual(merkle_root([a, b]), merkle_root([b, a]))
+
+
+class XorBlocksTest(unittest.TestCase):
+    
+    def test_recovers_a_block(self):
+        blocks = [os.urandom(64) for _ in range(4)]
+        parity = xor_blocks(blocks, 64)
+        self.assertEqual(xor_blocks(blocks[:2] + blocks[3:] + [parity], 64), blocks[2])
+    
+    def test_short_blocks_are_padded_at_the_end(self):
+        self.assertEqual(xor_blocks([b'\x01\x02', b'\x01'], 4), b'\x00\x02\x00\x00')
+    
+    def test_no_blocks(self):
+        self.assertEqual(xor_blocks([], 8), bytes(8))
+
+
+class CompressionTest(unittest.TestCase):
+    
+    def test_round_trip(self):
+        blocks = [bytes([idx]) * 1024 for idx in range(4)]
+        codec, payload, count = BlockCompressor(CODEC_ZLIB).compress(blocks, 1024)
+        self.assertEqual(codec, CODEC_ZLIB)
+        self.assertEqual(decompress_blocks(codec, payload, count * 1024), b''.join(blocks[:count]))
+    
+    def test_incompressible_blocks_are_sent_as_they_are(self):
+        blocks = [os.urandom(1024) for _ in range(4)]
+        self.assertEqual(BlockCompressor(CODEC_ZLIB).compress(blocks, 1024), (CODEC_NONE, blocks[0], 1))
+    
+    def test_garbage_is_refused(self):
+        with self.assertRaises(ValueError):
+            decompress_blocks(CODEC_ZLIB, b'\xff' * 32, 1024)
+    
+    def test_payload_larger_than_its_blocks_is_refused(self):
+        payload = BlockCompressor(CODEC_ZLIB).pack(bytes(4096))
+        with self.assertRaises(ValueError):
+            decompress_blocks(CODEC_ZLIB, payload, 1024)
+    
+    def test_truncated_payload_is_refused(self):
+        payload = BlockCompressor(CODEC_ZLIB).pack(bytes(4096))
+        with self.assertRaises(ValueError):
+            decompress_blocks(CODEC_ZLIB, payload[:len(payload) // 2], 4096)
+
+
+class DataHeaderTest(unittest.TestCase):
+    
+    def test_round_trip(self):
+        header = DataHeader(2)
+        self.assertEqual(header.unpack(header.pack(70000, 3, 0x80) + bytes(8)), (70000, 3, 0x80))
+        self.assertEqual(DataHeader(1).unpack(DataHeader(1).pack(513)), (513, 0, 0))
+    
+    def test_short_datagram(self):
+        for version in (1, 2):
+            header = DataHeader(version)
+            self.assertIsNone(header.unpack(header.pack(1)[:-1]))
+            self.assertIsNone(header.unpack(b''))
+    
+    def test_other_version(self):
+        self.assertIsNone(DataHeader(2).unpack(DataHeader(3).pack(1)))
+
+
+class BlocksOfTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.session = BaseServerSession(ServerSettings(10.0), 'f.bin', {}, DataHeader(2, 1024), None)
+        # 10 blocks, the last one short
+        self.session.segment_length = 9 * 1024 + 1
+    
+    def test_ranges(self):
+        self.assertEqual(list(self.session.blocks_of([(0, 2), (5, 7)])), [0, 1, 5, 6])
+        self.assertEqual(list(self.session.blocks_of([(3, 6)])), [3, 4, 5])
+    
+    def test_ranges_are_clamped_to_the_segment(self):
+        self.assertEqual(list(self.session.blocks_of([(8, 0xFFFFFFFF)])), [8, 9])
+        self.assertEqual(list(self.session.blocks_of([(2, 3), (10, 20), (50, 60)])), [2])
+        self.assertEqual(list(self.session.blocks_of([(10, 20)])), [])
+    
+    def test_reversed_range(self):
+        with self.assertRaises(ProtocolError):
+            self.session.blocks_of([(5, 2)])
+    
+    def test_overlapping_ranges(self):
+        with self.assertRaises(ProtocolError):
+            self.session.blocks_of([(0, 5), (3, 7)])
+
+
+if __name__ == '__main__':
+    unittest.main()